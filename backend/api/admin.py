@@ -2,6 +2,7 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth import get_user_model
 from .models import (
+    ConversationSummary,
     LoginAttempt,
     FriendRequest,
     FriendShip,
@@ -25,9 +26,17 @@ class CustomUserAdmin(UserAdmin):
     )
 
 @admin.register(Message)
+@admin.register(ConversationSummary)
 @admin.register(LoginAttempt)
-@admin.register(FriendShip)
-@admin.register(FriendRequest)
 
 class Admin(admin.ModelAdmin):
     pass
+
+# __str__ shows both users, join them instead of two queries per row
+@admin.register(FriendRequest)
+class FriendRequestAdmin(admin.ModelAdmin):
+    list_select_related = ["sender", "receiver"]
+
+@admin.register(FriendShip)
+class FriendShipAdmin(admin.ModelAdmin):
+    list_select_related = ["user1", "user2"]
@@ -0,0 +1,105 @@
+import atexit
+import logging
+import queue
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .models import LoginAttempt
+
+
+logger = logging.getLogger(__name__)
+
+
+class LoginAttemptBuffer:
+    """Collects login attempts in memory and writes them with bulk inserts.
+
+    A background thread flushes every ``flush_interval`` seconds or whenever
+    ``batch_size`` attempts are waiting. When ``max_size`` attempts are queued
+    the overflow policy applies: "sync" writes the attempt inline so no audit
+    record is lost, "drop" discards it and counts it in ``dropped``.
+    """
+
+    def __init__(self, max_size, batch_size, flush_interval, overflow):
+        self.queue = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._worker = None
+
+    def record(self, **fields):
+        fields["username"] = (fields.get("username") or "")[:30]
+        attempt = LoginAttempt(timestamp=timezone.now(), **fields)
+        self._start_worker()
+        try:
+            self.queue.put_nowait(attempt)
+        except queue.Full:
+            if self.overflow == "drop":
+                with self._lock:
+                    self.dropped += 1
+                logger.warning("Login attempt buffer full, dropped attempt")
+            else:
+                attempt.save()
+
+    def _start_worker(self):
+        # Started lazily so each forked worker process gets its own thread
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._stopping.clear()
+                self._worker = threading.Thread(
+                    target=self._run, name="login-attempt-buffer", daemon=True
+                )
+                self._worker.start()
+
+    def _take_batch(self, timeout):
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            LoginAttempt.objects.bulk_create(batch)
+        except Exception:
+            logger.exception("Could not write %d login attempts", len(batch))
+
+    def _run(self):
+        try:
+            while not self._stopping.is_set():
+                batch = self._take_batch(self.flush_interval)
+                if batch:
+                    self._write(batch)
+        finally:
+            connection.close()
+
+    def flush(self):
+        """Write everything queued so far from the calling thread"""
+        while True:
+            batch = self._take_batch(timeout=0)
+            if not batch:
+                return
+            self._write(batch)
+
+    def close(self):
+        self._stopping.set()
+        if self._worker is not None:
+            self._worker.join(self.flush_interval + 1)
+        self.flush()
+
+
+login_attempts = LoginAttemptBuffer(**settings.LOGIN_ATTEMPT_BUFFER)
+# Don't lose buffered audit records when the worker shuts down
+atexit.register(login_attempts.close)
@@ -1,23 +1,105 @@
+from django.utils.translation import gettext_lazy as _
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from .hashing import PoolOverloaded
+from .metrics import token_authentications
+from .usercache import user_cache
 
 
 class CustomJWTAuthentication(JWTAuthentication):
     def authenticate(self, request):
-        header = self.get_header(request)
-
-        if header is None:
-            raw_token = request.COOKIES.get("access_token") or None
-        else:
-            raw_token = self.get_raw_token(header)
-
+        raw_token = self.get_request_token(request)
         if raw_token is None:
             return None
         
         try:
             validated_token = self.get_validated_token(raw_token)
-            return self.get_user(validated_token), validated_token
+            user = self.get_user(validated_token)
+        except Exception:
+            token_authentications.inc("invalid")
+            return None
+        token_authentications.inc("valid")
+        return user, validated_token
+
+    async def aauthenticate(self, request):
+        """authenticate without a thread unless the user misses the local cache"""
+        raw_token = self.get_request_token(request)
+        if raw_token is None:
+            return None
+
+        try:
+            validated_token = self.get_validated_token(raw_token)
+            user = await self.aget_user(validated_token)
+        except PoolOverloaded:
+            raise
         except Exception:
+            token_authentications.inc("invalid")
             return None
+        token_authentications.inc("valid")
+        return user, validated_token
+
+    def get_request_token(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return request.COOKIES.get("access_token") or None
+        return self.get_raw_token(header)
+
+    def get_user(self, validated_token):
+        # Same checks as JWTAuthentication.get_user, but the user usually comes
+        # from the cache instead of a query per request
+        return self.check_user(user_cache.get(self.get_user_id(validated_token)), validated_token)
+
+    async def aget_user(self, validated_token):
+        user = await user_cache.aget(self.get_user_id(validated_token))
+        return self.check_user(user, validated_token)
+
+    @staticmethod
+    def get_user_id(validated_token):
+        try:
+            return validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+    @staticmethod
+    def check_user(user, validated_token):
+        if user is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(
+                api_settings.REVOKE_TOKEN_CLAIM
+            ) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(
+                    _("The user's password has been changed."), code="password_changed"
+                )
+
+        return user
+
+
+class TokenClaimsAuthentication(CustomJWTAuthentication):
+    """Trusts the verified token alone, request.user is a TokenUser"""
+
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+        return api_settings.TOKEN_USER_CLASS(validated_token)
+
 
+async def authenticate_async(request):
+    """Cookie or header JWT authentication for plain async views.
 
-    
\ No newline at end of file
+    Sets request.user and returns it, or returns None when the request
+    carries no valid token. Raises PoolOverloaded when looking up the user
+    can't get a thread.
+    """
+    authenticated = await CustomJWTAuthentication().aauthenticate(request)
+    if authenticated is None:
+        return None
+    request.user, request.auth = authenticated
+    return request.user
@@ -0,0 +1,26 @@
+import base64
+import os
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def random_b64(size, urlsafe=False):
+    raw = os.urandom(size)
+    if urlsafe:
+        return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+    return base64.b64encode(raw).decode()
+
+
+def random_public_key():
+    """P-256 shaped JWK, only needs to look like what the frontend uploads"""
+    return {
+        "kty": "EC",
+        "crv": "P-256",
+        "x": random_b64(32, urlsafe=True),
+        "y": random_b64(32, urlsafe=True),
+        "ext": True,
+        "key_ops": [],
+    }
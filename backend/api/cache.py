@@ -0,0 +1,17 @@
+from django.core.cache.backends import redis
+
+from .metrics import TimedRedis
+
+
+class RedisCacheClient(redis.RedisCacheClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._client = TimedRedis
+
+
+class RedisCache(redis.RedisCache):
+    """Django's Redis cache with command latency in the metrics"""
+
+    def __init__(self, server, params):
+        super().__init__(server, params)
+        self._class = RedisCacheClient
@@ -0,0 +1,110 @@
+import hashlib
+import random
+
+from django.core.cache import cache
+from django.http import HttpResponseNotModified
+from django.utils.http import parse_etags
+from rest_framework.response import Response
+
+from .threads import run_blocking
+
+
+# Version counters live in Redis and are bumped on every write that changes
+# what a list endpoint returns, so a poll can be answered from the counters.
+
+
+def friends_version(user_id):
+    return f"version:friends:{user_id}"
+
+
+def requests_version(user_id):
+    return f"version:requests:{user_id}"
+
+
+def messages_version(conversation):
+    return f"version:messages:{conversation}"
+
+
+def conversations_version(user_id):
+    return f"version:conversations:{user_id}"
+
+
+def profile_version(user_id):
+    return f"version:profile:{user_id}"
+
+
+def _initial_version():
+    # Random start so a counter evicted from Redis can't hand out an old ETag again
+    return random.getrandbits(48)
+
+
+def bump(*keys):
+    for key in keys:
+        cache.add(key, _initial_version(), None)
+        cache.incr(key)
+
+
+def make_etag(request, keys):
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _initial_version(), None)
+            versions[key] = cache.get(key)
+    return _etag(request, keys, versions)
+
+
+async def amake_etag(request, keys):
+    # cache.a* would each hop to the thread sensitive thread, this is one hop
+    # to a request thread
+    return await run_blocking(make_etag, request, keys)
+
+
+def _etag(request, keys, versions):
+    parts = [
+        request.path,
+        request.META.get("QUERY_STRING", ""),
+        # Same data in another format (JSON, MessagePack) is another representation
+        request.META.get("HTTP_ACCEPT", ""),
+        str(request.user.id),
+    ]
+    parts += [f"{key}={versions[key]}" for key in keys]
+    digest = hashlib.sha256("|".join(parts).encode()).hexdigest()[:32]
+    return f'W/"{digest}"'
+
+
+def not_modified(request, etag):
+    header = request.META.get("HTTP_IF_NONE_MATCH")
+    if not header:
+        return False
+    # Weak comparison, as required for If-None-Match
+    etags = [tag.removeprefix("W/") for tag in parse_etags(header)]
+    return "*" in etags or etag.removeprefix("W/") in etags
+
+
+def conditional_get(request, keys, build_response):
+    """Answer with 304 when the client's ETag still matches the counters,
+    otherwise build the full response and tag it."""
+    etag = make_etag(request, keys)
+    if not_modified(request, etag):
+        response = Response(status=304)
+    else:
+        response = build_response()
+    if response.status_code in (200, 304):
+        response["ETag"] = etag
+        # Let browsers keep the body but always revalidate
+        response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+async def aconditional_get(request, keys, build_response):
+    """conditional_get for async views, build_response returns a plain Django
+    response and runs on a request thread."""
+    etag = await amake_etag(request, keys)
+    if not_modified(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = await run_blocking(build_response)
+    if response.status_code in (200, 304):
+        response["ETag"] = etag
+        response["Cache-Control"] = "private, no-cache"
+    return response
@@ -0,0 +1,52 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+
+class PoolOverloaded(Exception):
+    pass
+
+
+class BoundedExecutor:
+    """Thread pool with admission control for blocking work from async code.
+
+    At most ``max_workers`` jobs run at once and ``max_pending`` more may
+    wait. A caller finding every slot taken gets PoolOverloaded, so a flood
+    is shed instead of queueing without bound.
+    """
+
+    def __init__(self, max_workers, max_pending, name):
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+
+    async def arun(self, fn, *args, **kwargs):
+        """Run fn on the pool, the event loop stays free while it runs"""
+        if not self._slots.acquire(blocking=False):
+            raise PoolOverloaded()
+        try:
+            # Carries the request's context over, e.g. its query metrics
+            context = contextvars.copy_context()
+            future = self._executor.submit(context.run, self._call, fn, args, kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The job keeps its slot until it finishes, even if the caller is cancelled
+        future.add_done_callback(lambda _: self._slots.release())
+        return await asyncio.wrap_future(future)
+
+    @staticmethod
+    def _call(fn, args, kwargs):
+        # Pool threads live outside the request cycle, so drop stale connections here
+        close_old_connections()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+
+# Argon2 verification, the most expensive thing a request can make us do
+password_hashing = BoundedExecutor(name="password-hash", **settings.PASSWORD_HASHING_POOL)
@@ -0,0 +1,149 @@
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Max, Q
+
+from .etags import bump, conversations_version, messages_version
+from .metrics import worker_id
+from .models import ConversationSummary, Message
+from .utils import get_redis
+
+
+logger = logging.getLogger(__name__)
+
+PURGE_BATCH_SIZE = 500
+PURGE_BATCH_PAUSE = 0.05  # seconds between batches, lets other writers in
+JOB_TTL = 60 * 60 * 24
+# A worker holds a job's lease while it heartbeats, a job whose lease ran out
+# lost its worker (crash, restart) and may be resumed by any other
+JOB_LEASE = 60
+ACTIVE_STATUSES = ("pending", "running")
+# Ids of pending and running jobs, so a starting worker can find orphans
+ACTIVE_JOBS_KEY = "jobs:message_purge:active"
+
+# One purge at a time per worker process, the rest wait in the queue
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="message-purge")
+
+
+def job_key(job_id):
+    return f"job:message_purge:{job_id}"
+
+
+def lease_key(job_id):
+    return f"{job_key(job_id)}:lease"
+
+
+def get_job(job_id):
+    return cache.get(job_key(job_id))
+
+
+def save_job(job):
+    cache.set(job_key(job["id"]), job, JOB_TTL)
+
+
+def user_messages(user_id):
+    return Message.objects.filter(Q(sender_id=user_id) | Q(receiver_id=user_id))
+
+
+def start_message_purge(user):
+    """Queue deletion of everything the user sent or received up to now"""
+    last_id = user_messages(user.id).aggregate(last_id=Max("id"))["last_id"]
+    job = {
+        "id": uuid.uuid4().hex,
+        "user_id": user.id,
+        "status": "pending" if last_id else "done",
+        "deleted": 0,
+        # Messages sent after the purge was requested are kept
+        "last_id": last_id,
+        # Everything up to here is deleted, a resumed job continues after it
+        "cursor": 0,
+        "owner": None,
+        "heartbeat": None,
+    }
+    save_job(job)
+    if last_id:
+        get_redis().sadd(ACTIVE_JOBS_KEY, job["id"])
+        resume_message_purge(job)
+    return job
+
+
+def resume_message_purge(job):
+    """Run the job on this worker unless a live worker holds its lease"""
+    if job["status"] not in ACTIVE_STATUSES:
+        return False
+    if not cache.add(lease_key(job["id"]), worker_id(), JOB_LEASE):
+        return False
+    _executor.submit(run_message_purge, dict(job))
+    return True
+
+
+def resume_stale_purges():
+    """Pick up jobs whose worker stopped heartbeating, called as a worker starts"""
+    client = get_redis()
+    for job_id in client.smembers(ACTIVE_JOBS_KEY):
+        job = get_job(job_id.decode())
+        if job is None or job["status"] not in ACTIVE_STATUSES:
+            client.srem(ACTIVE_JOBS_KEY, job_id)
+        elif resume_message_purge(job):
+            logger.info("Resuming message purge %s", job["id"])
+
+
+def heartbeat(job):
+    job["owner"] = worker_id()
+    job["heartbeat"] = time.time()
+    cache.set(lease_key(job["id"]), job["owner"], JOB_LEASE)
+    save_job(job)
+
+
+def finish(job):
+    save_job(job)
+    cache.delete(lease_key(job["id"]))
+    get_redis().srem(ACTIVE_JOBS_KEY, job["id"])
+
+
+def run_message_purge(job):
+    messages = user_messages(job["user_id"]).filter(id__lte=job["last_id"]).order_by("id")
+    cursor = job["cursor"]
+    job["status"] = "running"
+    heartbeat(job)
+    try:
+        while True:
+            batch = list(
+                messages.filter(id__gt=cursor).values_list("id", "conversation")[:PURGE_BATCH_SIZE]
+            )
+            if not batch:
+                break
+            # Each batch is its own short statement over a bounded id range
+            upper = batch[-1][0]
+            messages.filter(id__gt=cursor, id__lte=upper).delete()
+            cursor = job["cursor"] = upper
+            job["deleted"] += len(batch)
+            bump(*{messages_version(conversation) for _, conversation in batch})
+            heartbeat(job)
+            time.sleep(PURGE_BATCH_PAUSE)
+        # Last message and unread counts now point at deleted messages. All
+        # of the user's conversations, a resumed job doesn't know which ones
+        # the earlier batches touched
+        conversations = set(
+            ConversationSummary.for_user(job["user_id"]).values_list("conversation", flat=True)
+        )
+        ConversationSummary.rebuild(conversations)
+        bump(
+            *{
+                conversations_version(user_id)
+                for conversation in conversations
+                for user_id in ConversationSummary.participants(conversation)
+            }
+        )
+        job["status"] = "done"
+    except Exception:
+        logger.exception("Message purge %s failed", job["id"])
+        job["status"] = "failed"
+    finally:
+        finish(job)
+        # Worker threads don't go through request_finished, close explicitly
+        connection.close()
@@ -0,0 +1,91 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from api.benchmark import percentile
+from api.models import User, Message
+from api.views import get_message_page
+
+
+USERNAME_PREFIX = "bench_history_"
+PARTNERS_PER_USER = 10
+BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = "Measure conversation history read latency as the message table grows"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default="10000,100000,1000000",
+            help="Comma separated total message counts to measure at",
+        )
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--reads", type=int, default=200)
+        parser.add_argument(
+            "--keep", action="store_true", help="Keep the generated data afterwards"
+        )
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options["sizes"].split(","))
+        user_ids = self.create_users(options["users"])
+        pairs = [
+            (user_id, random.choice(user_ids))
+            for user_id in user_ids
+            for _ in range(PARTNERS_PER_USER)
+        ]
+        pairs = [(a, b) for a, b in pairs if a != b]
+
+        try:
+            stored = 0
+            for size in sizes:
+                self.insert_messages(pairs, size - stored)
+                stored = size
+                timings = self.time_reads(pairs, options["reads"])
+                self.stdout.write(
+                    f"{size:>10} messages: "
+                    f"p50 {percentile(timings, 50):.2f} ms, "
+                    f"p95 {percentile(timings, 95):.2f} ms, "
+                    f"mean {statistics.mean(timings):.2f} ms"
+                )
+        finally:
+            if not options["keep"]:
+                Message.objects.filter(sender_id__in=user_ids).delete()
+                User.objects.filter(id__in=user_ids).delete()
+
+    def create_users(self, count):
+        users = User.objects.bulk_create(
+            User(username=f"{USERNAME_PREFIX}{i}", password="!") for i in range(count)
+        )
+        return [user.id for user in users]
+
+    def insert_messages(self, pairs, count):
+        while count > 0:
+            batch = []
+            for _ in range(min(count, BATCH_SIZE)):
+                sender_id, receiver_id = random.choice(pairs)
+                if random.random() < 0.5:
+                    sender_id, receiver_id = receiver_id, sender_id
+                batch.append(
+                    Message(
+                        sender_id=sender_id,
+                        receiver_id=receiver_id,
+                        conversation=Message.conversation_key(sender_id, receiver_id),
+                        content=b"x" * 64,
+                        iv=b"y" * 12,
+                    )
+                )
+            Message.objects.bulk_create(batch)
+            count -= len(batch)
+
+    def time_reads(self, pairs, reads):
+        timings = []
+        for _ in range(reads):
+            user_id, other_user_id = random.choice(pairs)
+            user = User(id=user_id)
+            start = time.perf_counter()
+            get_message_page(Message.get_conversation(user, other_user_id), {})
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
@@ -0,0 +1,67 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import (
+    BlacklistedToken,
+    OutstandingToken,
+)
+
+from api.tokens import BLACKLIST_READY_KEY, BLACKLIST_READY_TTL, mirror_blacklisted
+from api.utils import get_redis
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete expired rows from the token blacklist tables and rebuild the "
+        "Redis blacklist mirror"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=0,
+            help="Repeat every this many seconds instead of running once",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            pruned = self.prune(options["batch_size"])
+            mirrored = self.mirror(options["interval"] or BLACKLIST_READY_TTL)
+            self.stdout.write(
+                f"Pruned {pruned} expired tokens, mirrored {mirrored} blacklisted tokens"
+            )
+            if not options["interval"]:
+                return
+            time.sleep(options["interval"])
+
+    def prune(self, batch_size):
+        # Small batches so the tables aren't locked for long,
+        # blacklist rows go with their outstanding token (cascade)
+        pruned = 0
+        while True:
+            ids = list(
+                OutstandingToken.objects.filter(expires_at__lte=timezone.now())
+                .order_by("id")
+                .values_list("id", flat=True)[:batch_size]
+            )
+            if not ids:
+                return pruned
+            OutstandingToken.objects.filter(id__in=ids).delete()
+            pruned += len(ids)
+
+    def mirror(self, ready_ttl):
+        client = get_redis()
+        pipeline = client.pipeline(transaction=False)
+        blacklisted = BlacklistedToken.objects.filter(
+            token__expires_at__gt=timezone.now()
+        ).values_list("token__jti", "token__expires_at")
+        count = 0
+        for jti, expires_at in blacklisted.iterator(chunk_size=1000):
+            mirror_blacklisted(pipeline, jti, expires_at.timestamp())
+            count += 1
+        pipeline.set(BLACKLIST_READY_KEY, 1, ex=ready_ttl)
+        pipeline.execute()
+        return count
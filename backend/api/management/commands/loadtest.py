@@ -0,0 +1,230 @@
+import json
+import random
+import statistics
+import threading
+import time
+from collections import defaultdict
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, Request, build_opener
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from api.benchmark import percentile, random_b64
+from api.models import FriendShip, User
+
+
+# Relative weight of each action in a simulated user's loop
+ACTIONS = ["friends", "poll", "send"]
+DEFAULT_MIX = "friends=3,poll=6,send=1"
+HTTP_TIMEOUT = 30  # seconds
+
+
+class PlainHttpCookiePolicy(DefaultCookiePolicy):
+    # The API marks its cookies Secure, dev servers speak plain HTTP
+    def return_ok_secure(self, cookie, request):
+        return True
+
+
+class HttpResult:
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class HttpClient:
+    """The part of django.test.Client the simulated users need, sent to a
+    running server instead"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.cookies = CookieJar(PlainHttpCookiePolicy())
+        self.opener = build_opener(HTTPCookieProcessor(self.cookies))
+
+    def get(self, path, data=None):
+        query = f"?{urlencode(data)}" if data else ""
+        return self.open(Request(f"{self.base_url}{path}{query}"))
+
+    def post(self, path, data):
+        request = Request(f"{self.base_url}{path}", urlencode(data).encode())
+        # Login sets the CSRF cookie, the test client skips the check
+        for cookie in self.cookies:
+            if cookie.name == settings.CSRF_COOKIE_NAME:
+                request.add_header("X-CSRFToken", cookie.value)
+        return self.open(request)
+
+    def open(self, request):
+        try:
+            with self.opener.open(request, timeout=HTTP_TIMEOUT) as response:
+                return HttpResult(response.status, response.read())
+        except HTTPError as error:
+            return HttpResult(error.code, error.read())
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive login, friends, message poll and send with concurrent simulated "
+        "users and report latency, throughput and queries per endpoint. "
+        "Run seed_data first. Requests go through the test client in this "
+        "process unless --base-url points at a running server."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20, help="Concurrent simulated users")
+        parser.add_argument("--duration", type=float, default=30, help="Seconds to run")
+        parser.add_argument("--prefix", default="load_", help="Username prefix used by seed_data")
+        parser.add_argument("--password", default="Load-test-password-1")
+        parser.add_argument("--seed", type=int, default=None, help="Random seed")
+        parser.add_argument(
+            "--mix",
+            default=DEFAULT_MIX,
+            help="Action weights, e.g. send=1 to measure writes only",
+        )
+        parser.add_argument(
+            "--base-url",
+            default=None,
+            help="Send real HTTP requests to this server, e.g. http://localhost:8000. "
+            "It must use the database seed_data ran against, queries aren't counted",
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        self.mix = self.parse_mix(options["mix"])
+        self.base_url = options["base_url"]
+        if self.base_url and options["users"] > settings.RATE_LIMITS["login"]["limit"]:
+            # Every simulated user logs in from this machine's address
+            self.stderr.write(
+                f"More than {settings.RATE_LIMITS['login']['limit']} users will hit the "
+                "server's login rate limit unless it has been raised there"
+            )
+        users = list(
+            User.objects.filter(username__startswith=options["prefix"])
+            .exclude(e2ee_public_key=None)
+            .values_list("id", "username")
+        )
+        with_friends = set(FriendShip.objects.values_list("user1_id", flat=True))
+        with_friends.update(FriendShip.objects.values_list("user2_id", flat=True))
+        users = [(user_id, name) for user_id, name in users if user_id in with_friends]
+        if len(users) < options["users"]:
+            raise CommandError(
+                f"Only {len(users)} seeded users with friends, run seed_data with more --users"
+            )
+
+        self.results = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+        deadline = time.monotonic() + options["duration"]
+        threads = [
+            threading.Thread(
+                target=self.simulate,
+                args=(index, user, options["password"], deadline, random.Random(rng.random())),
+            )
+            for index, user in enumerate(rng.sample(users, options["users"]))
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.report(time.perf_counter() - start)
+
+    def simulate(self, index, user, password, deadline, rng):
+        user_id, username = user
+        if self.base_url:
+            client = HttpClient(self.base_url)
+        else:
+            # Own address per user so the login rate limit behaves like real clients
+            client = Client(
+                REMOTE_ADDR=f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}"
+            )
+        try:
+            if not self.request("login", client.post, "/api/token/", {
+                "username": username,
+                "password": password,
+            }):
+                return
+            friend_ids = sorted(FriendShip.get_friend_ids(user_id))
+            cursors = {}
+            names = list(self.mix)
+            weights = list(self.mix.values())
+            while time.monotonic() < deadline:
+                action = rng.choices(names, weights)[0]
+                friend_id = rng.choice(friend_ids)
+                if action == "friends":
+                    self.request("friends", client.get, "/api/friends/")
+                elif action == "poll":
+                    params = {"with": friend_id, "limit": 50}
+                    if friend_id in cursors:
+                        params["after"] = cursors[friend_id]
+                    response = self.request("poll", client.get, "/api/message/", params)
+                    results = response.json()["results"] if response else None
+                    if results:
+                        cursors[friend_id] = results[-1]["id"]
+                else:
+                    self.request("send", client.post, "/api/message/", {
+                        "receiver_id": friend_id,
+                        "content": random_b64(rng.randint(16, 256)),
+                        "iv": random_b64(12),
+                    })
+        finally:
+            # Each thread has its own connection, don't leave it open
+            connection.close()
+
+    def parse_mix(self, value):
+        mix = {}
+        for part in value.split(","):
+            name, _, weight = part.partition("=")
+            if name not in ACTIONS or not weight.isdigit():
+                raise CommandError(f"Bad --mix entry {part!r}, expected one of {ACTIONS} with a weight")
+            mix[name] = int(weight)
+        if not any(mix.values()):
+            raise CommandError("--mix needs at least one action with a weight above zero")
+        return mix
+
+    def request(self, endpoint, method, *args):
+        # Only counts this thread's queries, login's password check runs in the hashing pool
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            try:
+                response = method(*args)
+            except OSError:
+                # Refused, reset or timed out, only happens with --base-url
+                response = None
+            elapsed = (time.perf_counter() - start) * 1000
+        with self.lock:
+            if response is None or response.status_code >= 400:
+                self.errors[endpoint] += 1
+                return None
+            # The server's queries can't be seen from here
+            self.results[endpoint].append((elapsed, None if self.base_url else len(queries)))
+        return response
+
+    def report(self, elapsed):
+        self.stdout.write(
+            f"{'endpoint':<10}{'ok':>8}{'errors':>8}{'req/s':>9}"
+            f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}"
+        )
+        for endpoint in ["login"] + ACTIONS:
+            samples = self.results[endpoint]
+            if not samples:
+                self.stdout.write(f"{endpoint:<10}{0:>8}{self.errors[endpoint]:>8}")
+                continue
+            timings = [timing for timing, _ in samples]
+            if self.base_url:
+                queries = f"{'-':>9}"
+            else:
+                queries = f"{statistics.mean(count for _, count in samples):>9.1f}"
+            self.stdout.write(
+                f"{endpoint:<10}{len(samples):>8}{self.errors[endpoint]:>8}"
+                f"{len(samples) / elapsed:>9.1f}"
+                f"{percentile(timings, 50):>9.2f}{percentile(timings, 95):>9.2f}"
+                f"{percentile(timings, 99):>9.2f}{queries}"
+            )
@@ -0,0 +1,125 @@
+import os
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.benchmark import random_public_key
+from api.models import (
+    ConversationSummary,
+    FriendRequest,
+    FriendShip,
+    Message,
+    User,
+    public_key_fingerprint,
+)
+
+
+BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate users with public keys, friendships, pending friend requests "
+        "and messages for load testing"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100)
+        parser.add_argument("--friends", type=int, default=10, help="Friends per user")
+        parser.add_argument("--pending", type=int, default=2, help="Pending requests per user")
+        parser.add_argument("--messages", type=int, default=10000, help="Total messages")
+        parser.add_argument("--prefix", default="load_", help="Username prefix")
+        parser.add_argument("--password", default="Load-test-password-1")
+        parser.add_argument("--seed", type=int, default=None, help="Random seed")
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+        prefix = options["prefix"]
+        if User.objects.filter(username__startswith=prefix).exists():
+            self.stderr.write(f"Users starting with {prefix!r} already exist, pick another --prefix")
+            return
+
+        user_ids = self.create_users(prefix, options["users"], options["password"])
+        friend_pairs = self.create_friendships(user_ids, options["friends"])
+        requests = self.create_requests(user_ids, friend_pairs, options["pending"])
+        messages = self.create_messages(sorted(friend_pairs), options["messages"])
+        self.stdout.write(
+            f"Created {len(user_ids)} users ({prefix}0..), {len(friend_pairs)} friendships, "
+            f"{requests} pending requests and {messages} messages. "
+            f"Password: {options['password']}"
+        )
+
+    def create_users(self, prefix, count, password):
+        # One hash for everyone, hashing each password would dominate the run
+        password_hash = make_password(password)
+        users = []
+        for i in range(count):
+            key = random_public_key()
+            users.append(
+                User(
+                    username=f"{prefix}{i}",
+                    password=password_hash,
+                    e2ee_public_key=key,
+                    e2ee_key_fingerprint=public_key_fingerprint(key),
+                )
+            )
+        created = User.objects.bulk_create(users, batch_size=BATCH_SIZE)
+        return [user.id for user in created]
+
+    def create_friendships(self, user_ids, per_user):
+        pairs = set()
+        if len(user_ids) < 2:
+            return pairs
+        for user_id in user_ids:
+            for other_id in random.sample(user_ids, min(per_user, len(user_ids) - 1) + 1):
+                if other_id != user_id:
+                    pairs.add(tuple(sorted((user_id, other_id))))
+        # bulk_create skips FriendShip.save, so the pairs are already canonical
+        FriendShip.objects.bulk_create(
+            [FriendShip(user1_id=low, user2_id=high) for low, high in pairs],
+            batch_size=BATCH_SIZE,
+        )
+        return pairs
+
+    def create_requests(self, user_ids, friend_pairs, per_user):
+        requested = set()
+        requests = []
+        for receiver_id in user_ids:
+            for sender_id in random.sample(user_ids, min(per_user, len(user_ids))):
+                pair = tuple(sorted((sender_id, receiver_id)))
+                if sender_id == receiver_id or pair in friend_pairs or pair in requested:
+                    continue
+                requested.add(pair)
+                requests.append(FriendRequest(sender_id=sender_id, receiver_id=receiver_id))
+        FriendRequest.objects.bulk_create(requests, batch_size=BATCH_SIZE)
+        return len(requests)
+
+    def create_messages(self, friend_pairs, count):
+        if not friend_pairs:
+            return 0
+        created = 0
+        while created < count:
+            batch = []
+            for _ in range(min(BATCH_SIZE, count - created)):
+                sender_id, receiver_id = random.choice(friend_pairs)
+                if random.random() < 0.5:
+                    sender_id, receiver_id = receiver_id, sender_id
+                batch.append(
+                    Message(
+                        sender_id=sender_id,
+                        receiver_id=receiver_id,
+                        conversation=Message.conversation_key(sender_id, receiver_id),
+                        content=os.urandom(random.randint(16, 256)),
+                        iv=os.urandom(12),
+                    )
+                )
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+            created += len(batch)
+        # bulk_create skips Message.save, which keeps the summaries current
+        ConversationSummary.rebuild(
+            Message.conversation_key(low, high) for low, high in friend_pairs
+        )
+        return created
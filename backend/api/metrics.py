@@ -0,0 +1,362 @@
+import hmac
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+import redis
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, JsonResponse
+
+
+logger = logging.getLogger(__name__)
+
+# Every worker process writes its snapshot here, /metrics sums them
+WORKERS_KEY = "metrics:workers"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+REDIS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+
+class Metric:
+    """Process local series keyed by label values, updates take one lock"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(labels), self.copy(value)] for labels, value in self.values.items()]
+
+    @staticmethod
+    def copy(value):
+        return value
+
+    def labels_text(self, labels, extra=()):
+        pairs = [*zip(self.labelnames, labels), *extra]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    @staticmethod
+    def merge(total, value):
+        return (total or 0) + value
+
+    def render(self, labels, value):
+        yield f"{self.name}{self.labels_text(labels)} {value}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    """Bucket counts are kept per bucket and only made cumulative on render"""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                # One count per bucket, then +Inf, sum
+                series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @staticmethod
+    def copy(value):
+        return list(value)
+
+    @staticmethod
+    def merge(total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def render(self, labels, value):
+        cumulative = 0
+        for bound, count in zip([*self.buckets, "+Inf"], value):
+            cumulative += count
+            le = bound if bound == "+Inf" else format_number(bound)
+            yield f"{self.name}_bucket{self.labels_text(labels, [('le', le)])} {cumulative}"
+        yield f"{self.name}_sum{self.labels_text(labels)} {value[-1]}"
+        yield f"{self.name}_count{self.labels_text(labels)} {cumulative}"
+
+
+def escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def format_number(value):
+    return repr(float(value))
+
+
+registry = []
+
+http_requests = Counter(
+    "http_requests_total", "HTTP responses by route, method and status",
+    ["route", "method", "status"],
+)
+http_duration = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route",
+    ["route", "method"],
+)
+db_queries = Histogram(
+    "db_queries_per_request", "Database queries made by one request",
+    ["route"], buckets=QUERY_COUNT_BUCKETS,
+)
+db_query_seconds = Counter(
+    "db_query_seconds_total", "Time spent in database queries by route", ["route"]
+)
+redis_duration = Histogram(
+    "redis_command_duration_seconds", "Redis command latency by command",
+    ["command"], buckets=REDIS_BUCKETS,
+)
+redis_errors = Counter("redis_errors_total", "Failed Redis commands", ["command"])
+login_attempts = Counter("login_attempts_total", "Password logins by result", ["result"])
+token_authentications = Counter(
+    "token_authentications_total", "Requests that presented a JWT, by result", ["result"]
+)
+rate_limit_rejections = Counter(
+    "rate_limit_rejections_total",
+    "Requests refused by a rate limit, ban is new when the request started the ban",
+    ["scope", "ban"],
+)
+message_waiters = Gauge("message_waiters", "Long-poll requests parked for new messages")
+websocket_connections = Gauge("websocket_connections", "Open message WebSockets")
+
+
+# Per-request query totals, the execute wrapper adds to whatever request
+# the current context belongs to, sync_to_async threads included
+_request_queries = ContextVar("request_queries", default=None)
+
+
+class QueryStats:
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+def time_query(execute, sql, params, many, context):
+    stats = _request_queries.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.count += 1
+        stats.seconds += time.perf_counter() - start
+
+
+def install_query_timer(sender, connection, **kwargs):
+    # Fires on every reconnect, the wrapper list lives as long as the alias
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+connection_created.connect(install_query_timer)
+
+
+class TimedRedis(redis.Redis):
+    """redis.Redis that records the latency of every command it sends"""
+
+    def execute_command(self, *args, **options):
+        command = str(args[0]).upper()
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        except redis.RedisError:
+            redis_errors.inc(command)
+            raise
+        finally:
+            redis_duration.observe(time.perf_counter() - start, command)
+
+
+def route_of(request):
+    match = request.resolver_match
+    if match is None:
+        # Unrouted paths would give every scanner probe its own series
+        return "unmatched"
+    return match.url_name or match.route
+
+
+class MetricsMiddleware:
+    """Request latency, status and query counts. Sync and async capable so
+    async views don't pay for a thread hop."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        start_flusher()
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats = QueryStats()
+        token = _request_queries.set(stats)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self.record(request, response, stats, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        stats = QueryStats()
+        token = _request_queries.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self.record(request, response, stats, time.perf_counter() - start)
+        return response
+
+    @staticmethod
+    def record(request, response, stats, elapsed):
+        route = route_of(request)
+        http_requests.inc(route, request.method, str(response.status_code))
+        http_duration.observe(elapsed, route, request.method)
+        db_queries.observe(stats.count, route)
+        if stats.seconds:
+            db_query_seconds.inc(route, amount=stats.seconds)
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def snapshot():
+    return {
+        "time": time.time(),
+        "metrics": {metric.name: metric.snapshot() for metric in registry},
+    }
+
+
+def flush():
+    # utils builds its client from TimedRedis, so import it late
+    from .utils import get_redis
+
+    get_redis().hset(WORKERS_KEY, worker_id(), json.dumps(snapshot()))
+
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def start_flusher():
+    global _flusher
+    with _flusher_lock:
+        if _flusher is not None and _flusher.is_alive():
+            return
+        _flusher = threading.Thread(target=_flush_forever, name="metrics-flush", daemon=True)
+        _flusher.start()
+
+
+def _flush_forever():
+    while True:
+        time.sleep(settings.METRICS["flush_interval"])
+        try:
+            flush()
+        except redis.RedisError:
+            logger.warning("Could not publish metrics", exc_info=True)
+
+
+def collect():
+    """Snapshots of every live worker, this one's taken fresh"""
+    from .utils import get_redis
+
+    local = snapshot()
+    try:
+        flush()
+        stored = get_redis().hgetall(WORKERS_KEY)
+    except redis.RedisError:
+        logger.warning("Metrics from other workers unavailable", exc_info=True)
+        return [local]
+
+    snapshots = [local]
+    stale = []
+    cutoff = time.time() - settings.METRICS["worker_ttl"]
+    for worker, data in stored.items():
+        if worker.decode() == worker_id():
+            continue
+        worker_snapshot = json.loads(data)
+        if worker_snapshot["time"] < cutoff:
+            stale.append(worker)
+        else:
+            snapshots.append(worker_snapshot)
+    if stale:
+        # Workers that exited or restarted
+        try:
+            get_redis().hdel(WORKERS_KEY, *stale)
+        except redis.RedisError:
+            pass
+    return snapshots
+
+
+def render(snapshots):
+    lines = []
+    for metric in registry:
+        totals = {}
+        for worker_snapshot in snapshots:
+            for labels, value in worker_snapshot["metrics"].get(metric.name, ()):
+                labels = tuple(labels)
+                totals[labels] = metric.merge(totals.get(labels), value)
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for labels in sorted(totals):
+            lines.extend(metric.render(labels, totals[labels]))
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view(request):
+    """Prometheus text exposition, needs Authorization: Bearer METRICS["token"]"""
+    token = settings.METRICS["token"]
+    if not token:
+        return JsonResponse({"detail": "Metrics are disabled."}, status=404)
+    header = request.headers.get("Authorization", "")
+    scheme, _, supplied = header.partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(supplied.encode(), token.encode()):
+        return JsonResponse({"detail": "Invalid metrics token."}, status=403)
+    return HttpResponse(render(collect()), content_type=CONTENT_TYPE)
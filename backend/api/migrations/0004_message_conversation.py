@@ -0,0 +1,42 @@
+# Generated by Django 5.2 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+def backfill_conversation(apps, schema_editor):
+    Message = apps.get_model("api", "Message")
+    batch = []
+    for message in Message.objects.only("id", "sender_id", "receiver_id").iterator(chunk_size=2000):
+        low, high = sorted((message.sender_id, message.receiver_id))
+        message.conversation = f"{low}:{high}"
+        batch.append(message)
+        if len(batch) >= 2000:
+            Message.objects.bulk_update(batch, ["conversation"])
+            batch = []
+    if batch:
+        Message.objects.bulk_update(batch, ["conversation"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_alter_user_e2ee_public_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='conversation',
+            field=models.CharField(default='', editable=False, max_length=41),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_conversation, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'id'], name='message_conversation_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'timestamp'], name='message_conv_time_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2 on 2026-10-18 11:00
+
+import hashlib
+import json
+import logging
+
+from django.db import migrations, models
+
+
+logger = logging.getLogger(__name__)
+
+
+def backfill_fingerprint(apps, schema_editor):
+    User = apps.get_model("api", "User")
+    seen = set()
+    cleared = []
+    users = User.objects.exclude(e2ee_public_key=None).only("id", "e2ee_public_key")
+    for user in users.order_by("id").iterator():
+        key = user.e2ee_public_key
+        if isinstance(key, dict) and key.get("crv") and key.get("x") and key.get("y"):
+            normalized = json.dumps([key.get("crv"), key.get("x"), key.get("y")])
+            fingerprint = hashlib.sha256(normalized.encode()).hexdigest()
+            if fingerprint not in seen:
+                seen.add(fingerprint)
+                User.objects.filter(pk=user.pk).update(e2ee_key_fingerprint=fingerprint)
+                continue
+        # Older rows could hold an invalid key or one an older account already
+        # has. Without a fingerprint has_key() is false, so the key goes too
+        # and the user sets up a new one
+        cleared.append(user.pk)
+    if cleared:
+        User.objects.filter(pk__in=cleared).update(e2ee_public_key=None)
+        logger.warning("Cleared the duplicate or invalid public keys of users %s", cleared)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_message_conversation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='e2ee_key_fingerprint',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_fingerprint, migrations.RunPython.noop),
+    ]
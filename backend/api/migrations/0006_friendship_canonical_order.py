@@ -0,0 +1,29 @@
+# Generated by Django 5.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+def canonicalize_friendships(apps, schema_editor):
+    FriendShip = apps.get_model("api", "FriendShip")
+    for friendship in FriendShip.objects.filter(user1_id__gt=models.F("user2_id")):
+        low, high = friendship.user2_id, friendship.user1_id
+        if FriendShip.objects.filter(user1_id=low, user2_id=high).exists():
+            # Same pair stored both ways, keep the canonical row
+            friendship.delete()
+        else:
+            FriendShip.objects.filter(pk=friendship.pk).update(user1_id=low, user2_id=high)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_user_e2ee_key_fingerprint'),
+    ]
+
+    operations = [
+        migrations.RunPython(canonicalize_friendships, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='friendship',
+            constraint=models.CheckConstraint(condition=models.Q(('user1__lt', models.F('user2'))), name='friendship_canonical_order'),
+        ),
+    ]
@@ -0,0 +1,105 @@
+# Generated by Django 5.2 on 2026-10-18 16:00
+
+import base64
+import binascii
+
+from django.db import migrations, models
+
+
+BATCH_SIZE = 2000
+
+
+def decode(value):
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        # Never written by the frontend, keep the text rather than lose it
+        return value.encode()
+
+
+def decode_ciphertext(apps, schema_editor):
+    Message = apps.get_model("api", "Message")
+    batch = []
+    for message in Message.objects.only("id", "content", "iv").iterator(chunk_size=BATCH_SIZE):
+        message.content_bytes = decode(message.content)
+        message.iv_bytes = decode(message.iv)
+        batch.append(message)
+        if len(batch) >= BATCH_SIZE:
+            Message.objects.bulk_update(batch, ["content_bytes", "iv_bytes"])
+            batch = []
+    if batch:
+        Message.objects.bulk_update(batch, ["content_bytes", "iv_bytes"])
+
+
+def encode_ciphertext(apps, schema_editor):
+    Message = apps.get_model("api", "Message")
+    batch = []
+    for message in Message.objects.only("id", "content_bytes", "iv_bytes").iterator(chunk_size=BATCH_SIZE):
+        message.content = base64.b64encode(message.content_bytes).decode()
+        message.iv = base64.b64encode(message.iv_bytes).decode()
+        batch.append(message)
+        if len(batch) >= BATCH_SIZE:
+            Message.objects.bulk_update(batch, ["content", "iv"])
+            batch = []
+    if batch:
+        Message.objects.bulk_update(batch, ["content", "iv"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_loginattempt_timestamp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='content_bytes',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='iv_bytes',
+            field=models.BinaryField(max_length=48, null=True),
+        ),
+        # Nullable while both copies exist, so the migration can be reversed
+        migrations.AlterField(
+            model_name='message',
+            name='content',
+            field=models.TextField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='iv',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.RunPython(decode_ciphertext, encode_ciphertext),
+        migrations.RemoveField(
+            model_name='message',
+            name='content',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='iv',
+        ),
+        migrations.RenameField(
+            model_name='message',
+            old_name='content_bytes',
+            new_name='content',
+        ),
+        migrations.RenameField(
+            model_name='message',
+            old_name='iv_bytes',
+            new_name='iv',
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='content',
+            field=models.BinaryField(),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='iv',
+            field=models.BinaryField(max_length=48),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 5.2 on 2026-10-18 17:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+BATCH_SIZE = 2000
+
+
+def backfill_summaries(apps, schema_editor):
+    Message = apps.get_model("api", "Message")
+    ConversationSummary = apps.get_model("api", "ConversationSummary")
+    last_ids = (
+        Message.objects.values("conversation")
+        .annotate(last_id=Max("id"))
+        .values_list("conversation", "last_id")
+        .order_by()
+    )
+    batch = []
+    for conversation, last_id in last_ids.iterator(chunk_size=BATCH_SIZE):
+        user1_id, user2_id = (int(user_id) for user_id in conversation.split(":"))
+        # No read state existed before, so history counts as read
+        batch.append(
+            ConversationSummary(
+                conversation=conversation,
+                user1_id=user1_id,
+                user2_id=user2_id,
+                last_message_id=last_id,
+                user1_read_id=last_id,
+                user2_read_id=last_id,
+            )
+        )
+        if len(batch) >= BATCH_SIZE:
+            save_batch(Message, ConversationSummary, batch)
+            batch = []
+    if batch:
+        save_batch(Message, ConversationSummary, batch)
+
+
+def save_batch(Message, ConversationSummary, summaries):
+    timestamps = dict(
+        Message.objects.filter(id__in=[summary.last_message_id for summary in summaries])
+        .values_list("id", "timestamp")
+    )
+    for summary in summaries:
+        summary.last_timestamp = timestamps[summary.last_message_id]
+    ConversationSummary.objects.bulk_create(summaries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_message_binary_ciphertext'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('conversation', models.CharField(max_length=41, unique=True)),
+                ('last_message_id', models.BigIntegerField(null=True)),
+                ('last_timestamp', models.DateTimeField(null=True)),
+                ('user1_read_id', models.BigIntegerField(default=0)),
+                ('user2_read_id', models.BigIntegerField(default=0)),
+                ('user1_unread', models.PositiveIntegerField(default=0)),
+                ('user2_unread', models.PositiveIntegerField(default=0)),
+                ('user1', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user2', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user1', '-last_timestamp'], name='conv_summary_user1_idx'), models.Index(fields=['user2', '-last_timestamp'], name='conv_summary_user2_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
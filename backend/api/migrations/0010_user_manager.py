@@ -0,0 +1,20 @@
+# Generated by Django 5.2 on 2026-10-18 12:56
+
+import api.models
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_conversationsummary'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='user',
+            managers=[
+                ('objects', api.models.UserManager()),
+            ],
+        ),
+    ]
@@ -1,15 +1,74 @@
-from django.db import models
-from django.db.models import UniqueConstraint
+import hashlib
+import json
+
+from django.db import models, transaction
+from django.db.models import Case, CheckConstraint, F, Q, UniqueConstraint, Value, When
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.utils import timezone
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager as BaseUserManager
+
+from .usercache import user_cache
+from .etags import (
+    bump,
+    conversations_version,
+    friends_version,
+    messages_version,
+    profile_version,
+    requests_version,
+)
+
+
+FRIEND_CACHE_TTL = 60 * 60  # seconds
+
+
+def public_key_fingerprint(key):
+    """Hash of the parts that identify an EC public key (crv, x, y)"""
+    normalized = json.dumps([key.get("crv"), key.get("x"), key.get("y")])
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+class UserQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        # Bulk updates skip User.save, evict the users from the auth cache here
+        user_ids = list(self.values_list("pk", flat=True))
+        result = super().update(**kwargs)
+        for user_id in user_ids:
+            user_cache.invalidate(user_id)
+        return result
+
+
+class UserManager(BaseUserManager.from_queryset(UserQuerySet)):
+    pass
 
 
 class User(AbstractUser):
+    objects = UserManager()
+
     e2ee_public_key = models.JSONField(unique=True, null=True, blank=True)
+    # Indexed so duplicate keys are found with one lookup instead of a table scan
+    e2ee_key_fingerprint = models.CharField(
+        max_length=64, unique=True, null=True, blank=True, editable=False
+    )
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_public_key = instance.__dict__.get("e2ee_public_key")
+        return instance
+
+    def public_key_changed(self):
+        if self._state.adding:
+            return self.e2ee_public_key is not None
+        return self.e2ee_public_key != getattr(self, "_saved_public_key", None)
 
     def clean(self):
         super().clean()
+        if not self.public_key_changed():
+            return
+
         if self.e2ee_public_key:
             x = self.e2ee_public_key.get("x")
             y = self.e2ee_public_key.get("y")
@@ -17,33 +76,82 @@ class User(AbstractUser):
 
             if not (x and y and crv):
                 raise ValidationError("Invalid public key")
-            
+
             # Check for duplicate public keys
-            for user in User.objects.exclude(pk=self.pk).iterator():
-                key = user.e2ee_public_key
-                if not key:
-                    continue
-                if key.get("x") == x and key.get("y") == y and key.get("crv") == crv:
-                    raise ValidationError("Public key already in use")
+            fingerprint = public_key_fingerprint(self.e2ee_public_key)
+            if User.objects.filter(e2ee_key_fingerprint=fingerprint).exclude(pk=self.pk).exists():
+                raise ValidationError("Public key already in use")
+            self.e2ee_key_fingerprint = fingerprint
+        else:
+            self.e2ee_key_fingerprint = None
 
     def has_key(self):
-        if self.e2ee_public_key is None:
-            return False
-        else:
-            return True
+        # clean() keeps the fingerprint in step with the key, and unlike the
+        # key it is loaded on users from the auth cache
+        return self.e2ee_key_fingerprint is not None
     
     def save(self, *args, **kwargs):
-        self.full_clean()
+        key_changed = not self._state.adding and self.public_key_changed()
+        # Key uniqueness is checked in clean(), and only when the key changed
+        self.full_clean(exclude=["e2ee_public_key", "e2ee_key_fingerprint"])
         super().save(*args, **kwargs)
+        self._saved_public_key = self.e2ee_public_key
+        # Covers profile updates and password changes
+        user_cache.invalidate(self.pk)
+        if key_changed:
+            self.bump_key_versions()
+
+    def bump_key_versions(self):
+        # Friend lists, requests and chats embed this key, so their ETags go stale
+        request_pairs = FriendRequest.objects.filter(
+            Q(sender=self) | Q(receiver=self)
+        ).values_list("sender_id", "receiver_id")
+        bump(
+            profile_version(self.id),
+            *[friends_version(friend_id) for friend_id in FriendShip.get_friend_ids(self.id)],
+            *{requests_version(user_id) for pair in request_pairs for user_id in pair},
+        )
             
     
 
+@receiver(post_delete, sender=User)
+def evict_deleted_user(sender, instance, **kwargs):
+    # Also sent for queryset deletes, which skip Model.delete
+    user_cache.invalidate(instance.pk)
+
+
+@receiver(pre_delete, sender=User)
+def refresh_counterparts_of_deleted_user(sender, instance, **kwargs):
+    # The user's friendships and requests cascade as bulk deletes, which skip
+    # their delete(), so the other sides' friend ids and versions are
+    # refreshed here once the rows are gone
+    user_id = instance.pk
+    friend_pairs = FriendShip.objects.filter(
+        Q(user1=instance) | Q(user2=instance)
+    ).values_list("user1_id", "user2_id")
+    friend_ids = {user_id for pair in friend_pairs for user_id in pair}
+    request_pairs = FriendRequest.objects.filter(
+        Q(sender=instance) | Q(receiver=instance)
+    ).values_list("sender_id", "receiver_id")
+    request_user_ids = {user_id for pair in request_pairs for user_id in pair}
+
+    def refresh():
+        FriendShip.invalidate_friend_cache(user_id, *friend_ids)
+        bump(
+            *[friends_version(user_id) for user_id in friend_ids],
+            *[requests_version(user_id) for user_id in request_user_ids],
+        )
+
+    transaction.on_commit(refresh)
+
+
 class LoginAttempt(models.Model):
     username = models.CharField(max_length=30)
     success = models.BooleanField()
     ip_address = models.GenericIPAddressField(null=True, blank=True)
     user_env = models.TextField(null=True, blank=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the attempt happens, rows are written later in batches
+    timestamp = models.DateTimeField(default=timezone.now)
     reason = models.TextField(null=True, blank=True)
 
     def __str__(self):
@@ -72,9 +180,34 @@ class FriendRequest(models.Model):
     def save(self, *args, **kwargs):
         self.full_clean()
         super().save(*args, **kwargs)
+        bump(requests_version(self.sender_id), requests_version(self.receiver_id))
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        bump(requests_version(self.sender_id), requests_version(self.receiver_id))
+        return result
+
+    @staticmethod
+    def pending_for(user_id):
+        """Pending requests sent or received by the user, profiles joined in"""
+        profile = ["id", "username", "e2ee_public_key"]
+        return (
+            FriendRequest.objects.filter(
+                Q(sender_id=user_id) | Q(receiver_id=user_id), status="pending"
+            )
+            .select_related("sender", "receiver")
+            .only(
+                "id",
+                "status",
+                "created_at",
+                *[f"sender__{field}" for field in profile],
+                *[f"receiver__{field}" for field in profile],
+            )
+            .order_by("id")
+        )
 
     def accept(self):
-        FriendShip.objects.create(user1=self.sender, user2= self.receiver)
+        FriendShip.objects.create(user1_id=self.sender_id, user2_id=self.receiver_id)
         self.delete()
 
     def reject(self):
@@ -87,20 +220,233 @@ class FriendShip(models.Model):
     
     class Meta:
         constraints = [
-            UniqueConstraint(fields=['user1','user2'], name='friendship_constraint')
+            UniqueConstraint(fields=['user1','user2'], name='friendship_constraint'),
+            # Lower id is always user1, so a pair is stored exactly one way
+            CheckConstraint(condition=Q(user1__lt=F('user2')), name='friendship_canonical_order'),
         ]
     def __str__(self):
         return f"{self.user1.get_username()} & {self.user2.get_username()}"
-    
+
+    def save(self, *args, **kwargs):
+        if self.user1_id > self.user2_id:
+            # Swapping ids keeps unloaded users unloaded
+            self.user1_id, self.user2_id = self.user2_id, self.user1_id
+        super().save(*args, **kwargs)
+        FriendShip.invalidate_friend_cache(self.user1_id, self.user2_id)
+        bump(friends_version(self.user1_id), friends_version(self.user2_id))
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        FriendShip.invalidate_friend_cache(self.user1_id, self.user2_id)
+        bump(friends_version(self.user1_id), friends_version(self.user2_id))
+        return result
+
+    @staticmethod
+    def friend_cache_key(user_id):
+        return f"friend_ids:{user_id}"
+
+    @staticmethod
+    def invalidate_friend_cache(*user_ids):
+        cache.delete_many([FriendShip.friend_cache_key(user_id) for user_id in user_ids])
+
+    @staticmethod
+    def get_friend_ids(user_id):
+        key = FriendShip.friend_cache_key(user_id)
+        friend_ids = cache.get(key)
+        if friend_ids is None:
+            pairs = FriendShip.objects.filter(Q(user1_id=user_id) | Q(user2_id=user_id))
+            friend_ids = [
+                user2_id if user1_id == user_id else user1_id
+                for user1_id, user2_id in pairs.values_list("user1_id", "user2_id")
+            ]
+            cache.set(key, friend_ids, FRIEND_CACHE_TTL)
+        return set(friend_ids)
+
+    @staticmethod
+    def are_friends(user_id, other_user_id):
+        return other_user_id in FriendShip.get_friend_ids(user_id)
+
+    @staticmethod
+    def friends_query(user, friend_ids):
+        friends = User.objects.only("id", "username", "e2ee_public_key")
+        if friend_ids is not None:
+            return friends.filter(id__in=friend_ids)
+        # One query with subqueries, the result also fills the cache
+        return friends.filter(
+            Q(id__in=FriendShip.objects.filter(user1=user).values("user2"))
+            | Q(id__in=FriendShip.objects.filter(user2=user).values("user1"))
+        )
+
     @staticmethod
     def get_friends(user):
-        friendships = FriendShip.objects.filter(models.Q(user1=user) | models.Q(user2=user))
-        friends = [f.user2 if f.user1 == user else f.user1 for f in friendships]
+        key = FriendShip.friend_cache_key(user.id)
+        friend_ids = cache.get(key)
+        friends = list(FriendShip.friends_query(user, friend_ids))
+        if friend_ids is None:
+            cache.set(key, [friend.id for friend in friends], FRIEND_CACHE_TTL)
         return friends
     
 class Message(models.Model):
     sender = models.ForeignKey(User, related_name='sent_messages', on_delete=models.CASCADE)
     receiver = models.ForeignKey(User, related_name='received_messages', on_delete=models.CASCADE)
-    content = models.TextField() # Encrypted
+    # Raw bytes, the API sends them as base64 in JSON and as-is in MessagePack
+    content = models.BinaryField() # Encrypted
     timestamp = models.DateTimeField(auto_now_add=True)
-    iv = models.CharField(max_length=64) # for AES-GCM
\ No newline at end of file
+    iv = models.BinaryField(max_length=48) # for AES-GCM
+    # Ordered user id pair ("<low>:<high>"), same for both directions of a chat
+    conversation = models.CharField(max_length=41, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["conversation", "id"], name="message_conversation_idx"),
+            models.Index(fields=["conversation", "timestamp"], name="message_conv_time_idx"),
+        ]
+
+    @staticmethod
+    def conversation_key(user_id, other_user_id):
+        low, high = sorted((int(user_id), int(other_user_id)))
+        return f"{low}:{high}"
+
+    @staticmethod
+    def get_conversation(user, other_user_id):
+        return Message.objects.filter(
+            conversation=Message.conversation_key(user.id, other_user_id)
+        )
+
+    def save(self, *args, **kwargs):
+        if not self.conversation:
+            self.conversation = Message.conversation_key(self.sender_id, self.receiver_id)
+        if not self._state.adding:
+            super().save(*args, **kwargs)
+            bump(messages_version(self.conversation))
+            return
+        # The summary moves in the same transaction as the insert
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            ConversationSummary.record_messages([self])
+        bump(
+            messages_version(self.conversation),
+            conversations_version(self.sender_id),
+            conversations_version(self.receiver_id),
+        )
+
+
+class ConversationSummary(models.Model):
+    """Latest message and per-participant read state of one conversation.
+
+    Updated with every message insert so chat lists don't read message history.
+    user1 is always the participant with the lower id, like in FriendShip.
+    """
+
+    conversation = models.CharField(max_length=41, unique=True)
+    user1 = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE, db_index=False)
+    user2 = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE, db_index=False)
+    last_message_id = models.BigIntegerField(null=True)
+    last_timestamp = models.DateTimeField(null=True)
+    # Id of the newest message each participant has read
+    user1_read_id = models.BigIntegerField(default=0)
+    user2_read_id = models.BigIntegerField(default=0)
+    user1_unread = models.PositiveIntegerField(default=0)
+    user2_unread = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user1", "-last_timestamp"], name="conv_summary_user1_idx"),
+            models.Index(fields=["user2", "-last_timestamp"], name="conv_summary_user2_idx"),
+        ]
+
+    @staticmethod
+    def for_user(user_id):
+        return ConversationSummary.objects.filter(
+            Q(user1_id=user_id) | Q(user2_id=user_id)
+        ).order_by("-last_timestamp")
+
+    @staticmethod
+    def participants(conversation):
+        user1_id, user2_id = conversation.split(":")
+        return int(user1_id), int(user2_id)
+
+    @staticmethod
+    def record_messages(messages):
+        """Advance the summaries for newly stored messages, call inside their transaction"""
+        by_conversation = {}
+        for message in messages:
+            by_conversation.setdefault(message.conversation, []).append(message)
+
+        for conversation, batch in by_conversation.items():
+            user1_id, user2_id = ConversationSummary.participants(conversation)
+            last = max(batch, key=lambda message: message.id)
+            to_user1 = sum(1 for message in batch if message.receiver_id == user1_id)
+            # A transaction that got its ids earlier may commit after one with
+            # newer messages, the latest message must not move backwards
+            newer = Q(last_message_id__isnull=True) | Q(last_message_id__lt=last.id)
+            changes = {
+                "last_message_id": Case(
+                    When(newer, then=Value(last.id)),
+                    default=F("last_message_id"),
+                    output_field=models.BigIntegerField(),
+                ),
+                "last_timestamp": Case(
+                    When(newer, then=Value(last.timestamp)), default=F("last_timestamp")
+                ),
+                "user1_unread": F("user1_unread") + to_user1,
+                "user2_unread": F("user2_unread") + len(batch) - to_user1,
+            }
+            summaries = ConversationSummary.objects.filter(conversation=conversation)
+            if not summaries.update(**changes):
+                # First message of the conversation
+                ConversationSummary.objects.get_or_create(
+                    conversation=conversation,
+                    defaults={"user1_id": user1_id, "user2_id": user2_id},
+                )
+                summaries.update(**changes)
+
+    @staticmethod
+    def rebuild(conversations):
+        """Recompute summaries from the message table, e.g. after bulk inserts or deletes"""
+        for conversation in conversations:
+            user1_id, user2_id = ConversationSummary.participants(conversation)
+            messages = Message.objects.filter(conversation=conversation)
+            with transaction.atomic():
+                last = messages.order_by("-id").only("id", "timestamp").first()
+                if last is None:
+                    # Chat lists only show conversations that have messages
+                    ConversationSummary.objects.filter(conversation=conversation).delete()
+                    continue
+                summary, _ = ConversationSummary.objects.select_for_update().get_or_create(
+                    conversation=conversation,
+                    defaults={"user1_id": user1_id, "user2_id": user2_id},
+                )
+                summary.last_message_id = last.id
+                summary.last_timestamp = last.timestamp
+                summary.user1_unread = messages.filter(
+                    receiver_id=user1_id, id__gt=summary.user1_read_id
+                ).count()
+                summary.user2_unread = messages.filter(
+                    receiver_id=user2_id, id__gt=summary.user2_read_id
+                ).count()
+                summary.save()
+
+    def side(self, user_id):
+        return "user1" if user_id == self.user1_id else "user2"
+
+    def read_state(self, user_id):
+        """(read_id, unread) of one participant"""
+        side = self.side(user_id)
+        return getattr(self, f"{side}_read_id"), getattr(self, f"{side}_unread")
+
+    def mark_read(self, user_id, message_id):
+        """Move user_id's read marker up to message_id and recount their unread"""
+        side = self.side(user_id)
+        if message_id <= getattr(self, f"{side}_read_id"):
+            return False
+        setattr(self, f"{side}_read_id", message_id)
+        setattr(
+            self,
+            f"{side}_unread",
+            Message.objects.filter(
+                conversation=self.conversation, receiver_id=user_id, id__gt=message_id
+            ).count(),
+        )
+        self.save(update_fields=[f"{side}_read_id", f"{side}_unread"])
+        return True
@@ -0,0 +1,156 @@
+import logging
+import re
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db.backends.signals import connection_created
+
+
+logger = logging.getLogger(__name__)
+
+_STRING = re.compile(r"'(?:''|[^'])*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDERS = re.compile(r"\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)")
+# Nested atomic blocks, repeating these is not a lazy load
+_TRANSACTION_CONTROL = ("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_shape(sql):
+    """The statement with its literals and IN lists folded, so the same
+    query for different rows compares equal"""
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    return _PLACEHOLDERS.sub("(...)", sql)
+
+
+class QueryLog:
+    """SQL run while recording, in order"""
+
+    def __init__(self):
+        self.statements = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    def repeated(self, threshold):
+        """(shape, count) for every shape run at least ``threshold`` times,
+        the usual sign of a lazy load per row"""
+        if len(self.statements) < threshold:
+            return []
+        shapes = Counter(
+            query_shape(sql)
+            for sql in self.statements
+            if not sql.startswith(_TRANSACTION_CONTROL)
+        )
+        return [(shape, count) for shape, count in shapes.most_common() if count >= threshold]
+
+    def problems(self, name, budget=None, threshold=None):
+        """Human readable budget and N+1 violations, empty when within limits"""
+        if threshold is None:
+            threshold = settings.QUERY_BUDGET["repeat_threshold"]
+        problems = []
+        if budget is not None and len(self) > budget:
+            problems.append(f"{name} ran {len(self)} queries, budget is {budget}")
+        for shape, count in self.repeated(threshold):
+            problems.append(f"{name} ran the same query {count} times (N+1?): {shape}")
+        return problems
+
+
+# The log of the request the current context belongs to, reaches
+# sync_to_async threads like the metrics' query stats
+_query_log = ContextVar("query_log", default=None)
+
+
+def log_query(execute, sql, params, many, context):
+    log = _query_log.get()
+    if log is not None:
+        log.statements.append(sql)
+    return execute(sql, params, many, context)
+
+
+def install_query_log(sender, connection, **kwargs):
+    if log_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(log_query)
+
+
+connection_created.connect(install_query_log)
+
+
+@contextmanager
+def record_queries():
+    """Collect every statement run in this context into a QueryLog"""
+    log = QueryLog()
+    token = _query_log.set(log)
+    try:
+        yield log
+    finally:
+        _query_log.reset(token)
+
+
+@contextmanager
+def max_queries(budget, name="block", threshold=None):
+    """Test helper, fails when the block runs more than ``budget`` queries
+    or repeats one ``threshold`` times"""
+    with record_queries() as log:
+        yield log
+    problems = log.problems(name, budget, threshold)
+    if problems:
+        raise QueryBudgetExceeded("\n".join(problems))
+
+
+def view_name(request):
+    match = request.resolver_match
+    return match.view_name if match is not None else None
+
+
+class QueryBudgetMiddleware:
+    """Checks each request against QUERY_BUDGET["budgets"], keyed by URL
+    name, and for repeated query shapes. Logs problems, raises
+    QueryBudgetExceeded instead when "strict" is set (tests, CI)."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.QUERY_BUDGET["enabled"]:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with record_queries() as log:
+            response = self.get_response(request)
+        self.check(request, log)
+        return response
+
+    async def __acall__(self, request):
+        with record_queries() as log:
+            response = await self.get_response(request)
+        self.check(request, log)
+        return response
+
+    @staticmethod
+    def check(request, log):
+        name = view_name(request)
+        if name is None:
+            return
+        config = settings.QUERY_BUDGET
+        problems = log.problems(name, config["budgets"].get(name))
+        if not problems:
+            return
+        if config["strict"]:
+            raise QueryBudgetExceeded("\n".join(problems))
+        for problem in problems:
+            logger.warning(problem)
@@ -0,0 +1,78 @@
+from typing import NamedTuple
+
+from django.conf import settings
+
+from .metrics import rate_limit_rejections
+from .utils import get_redis
+
+
+# One round-trip does the ban lookup, the hit count and, when the limit is
+# exceeded, the progressive ban escalation.
+# KEYS: ban, hits, violations
+# ARGV: limit, window, violation ttl, ban durations...
+# Returns {status, seconds}: 0 allowed, 1 already banned, 2 banned just now
+RATE_LIMIT_SCRIPT = """
+local ban_ttl = redis.call("TTL", KEYS[1])
+if ban_ttl > 0 then
+    return {1, ban_ttl}
+end
+
+local hits = redis.call("INCR", KEYS[2])
+if hits == 1 then
+    redis.call("EXPIRE", KEYS[2], ARGV[2])
+end
+if hits <= tonumber(ARGV[1]) then
+    return {0, 0}
+end
+
+local violations = redis.call("INCR", KEYS[3])
+redis.call("EXPIRE", KEYS[3], ARGV[3])
+local step = math.min(violations, #ARGV - 3)
+local duration = tonumber(ARGV[3 + step])
+redis.call("SET", KEYS[1], 1, "EX", duration)
+redis.call("DEL", KEYS[2])
+return {2, duration}
+"""
+
+ALLOWED = 0
+BANNED = 1
+LIMITED = 2
+
+_script = None
+
+
+class RateLimitResult(NamedTuple):
+    status: int
+    retry_after: int  # seconds until the ban ends
+
+    @property
+    def allowed(self):
+        return self.status == ALLOWED
+
+
+def check_rate_limit(scope, ip):
+    """Count a request from ``ip`` against the RATE_LIMITS[scope] rule.
+
+    Bans and violations are per scope and ip, so going over one limit doesn't
+    block the other endpoints. Each further violation in a scope makes its
+    next ban longer (RATE_LIMIT_BAN_DURATIONS).
+    """
+    global _script
+    if _script is None:
+        # Sent with EVALSHA, the script body only goes over the wire once
+        _script = get_redis().register_script(RATE_LIMIT_SCRIPT)
+
+    rule = settings.RATE_LIMITS[scope]
+    status, retry_after = _script(
+        keys=[f"ban:{scope}:{ip}", f"rate_hits:{scope}:{ip}", f"rate_violation:{scope}:{ip}"],
+        args=[
+            rule["limit"],
+            rule["window"],
+            settings.RATE_LIMIT_VIOLATION_TTL,
+            *settings.RATE_LIMIT_BAN_DURATIONS,
+        ],
+    )
+    result = RateLimitResult(int(status), int(retry_after))
+    if not result.allowed:
+        rate_limit_rejections.inc(scope, "new" if result.status == LIMITED else "active")
+    return result
@@ -0,0 +1,183 @@
+import asyncio
+import base64
+import json
+import logging
+from http.cookies import SimpleCookie
+
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+
+from .authentication import CustomJWTAuthentication
+from .hashing import PoolOverloaded
+from .metrics import websocket_connections
+from .utils import get_redis
+
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKET_PATH = "/ws/messages/"
+SOCKET_QUEUE_SIZE = 100
+
+
+def user_channel(user_id):
+    return f"chat:user:{user_id}"
+
+
+def message_envelope(message):
+    """Ciphertext envelope pushed to the receiver, no user profiles"""
+    return {
+        "type": "message",
+        "message": {
+            "id": message.id,
+            "sender_id": message.sender_id,
+            "receiver_id": message.receiver_id,
+            "content": base64.b64encode(bytes(message.content)).decode(),
+            "iv": base64.b64encode(bytes(message.iv)).decode(),
+            "timestamp": message.timestamp.isoformat(),
+        },
+    }
+
+
+def publish_message(message):
+    """Fan a stored message out to the receiver's sockets on every worker"""
+    try:
+        get_redis().publish(
+            user_channel(message.receiver_id), json.dumps(message_envelope(message))
+        )
+    except redis.RedisError:
+        # The message is stored, clients still get it through the history API
+        logger.warning("Could not publish message %s", message.id, exc_info=True)
+
+
+class MessageHub:
+    """One Redis subscription per worker process, shared by all its sockets"""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.pubsub = aioredis.Redis.from_url(settings.REDIS_URL).pubsub(
+            ignore_subscribe_messages=True
+        )
+        self.queues = {}
+        self.reader = None
+
+    async def subscribe(self, user_id):
+        queue = asyncio.Queue(maxsize=SOCKET_QUEUE_SIZE)
+        channel = user_channel(user_id)
+        listeners = self.queues.setdefault(channel, set())
+        listeners.add(queue)
+        if len(listeners) == 1:
+            try:
+                await self.pubsub.subscribe(channel)
+            except redis.RedisError:
+                del self.queues[channel]
+                raise
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.create_task(self.read())
+        return queue
+
+    async def unsubscribe(self, user_id, queue):
+        channel = user_channel(user_id)
+        listeners = self.queues.get(channel)
+        if listeners is None:
+            return
+        listeners.discard(queue)
+        if not listeners:
+            del self.queues[channel]
+            await self.pubsub.unsubscribe(channel)
+
+    async def read(self):
+        while self.queues:
+            try:
+                message = await self.pubsub.get_message(timeout=1.0)
+            except redis.RedisError:
+                logger.warning("Message hub lost its Redis subscription", exc_info=True)
+                await asyncio.sleep(1)
+                continue
+            if message is None:
+                continue
+            channel = message["channel"].decode()
+            for queue in self.queues.get(channel, ()):
+                try:
+                    queue.put_nowait(message["data"])
+                except asyncio.QueueFull:
+                    # Slow client, it can catch up with ?after= on the history API
+                    pass
+
+
+_hub = None
+
+
+def get_hub():
+    global _hub
+    if _hub is None or _hub.loop is not asyncio.get_running_loop():
+        _hub = MessageHub()
+    return _hub
+
+
+async def _authenticate(raw_token):
+    authentication = CustomJWTAuthentication()
+    try:
+        validated_token = authentication.get_validated_token(raw_token)
+        return await authentication.aget_user(validated_token)
+    except PoolOverloaded:
+        raise
+    except Exception:
+        return None
+
+
+def _header(scope, name):
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def websocket_application(scope, receive, send):
+    """Push new messages to the authenticated user over a WebSocket"""
+    event = await receive()
+    if event["type"] != "websocket.connect":
+        return
+
+    # Cookies are sent cross-site too, so only trust our own frontends
+    origin = _header(scope, b"origin")
+    if origin not in settings.CSRF_TRUSTED_ORIGINS:
+        await send({"type": "websocket.close", "code": 4403})
+        return
+
+    cookies = SimpleCookie(_header(scope, b"cookie") or "")
+    raw_token = cookies["access_token"].value if "access_token" in cookies else None
+    try:
+        user = await _authenticate(raw_token) if raw_token else None
+    except PoolOverloaded:
+        # Try again later
+        await send({"type": "websocket.close", "code": 1013})
+        return
+    if user is None:
+        await send({"type": "websocket.close", "code": 4401})
+        return
+
+    hub = get_hub()
+    try:
+        queue = await hub.subscribe(user.id)
+    except redis.RedisError:
+        await send({"type": "websocket.close", "code": 1011})
+        return
+    await send({"type": "websocket.accept"})
+    websocket_connections.inc()
+
+    async def forward():
+        while True:
+            data = await queue.get()
+            await send({"type": "websocket.send", "text": data.decode()})
+
+    forwarder = asyncio.create_task(forward())
+    try:
+        while True:
+            event = await receive()
+            if event["type"] == "websocket.disconnect":
+                break
+    finally:
+        websocket_connections.dec()
+        forwarder.cancel()
+        await hub.unsubscribe(user.id, queue)
@@ -0,0 +1,50 @@
+import msgpack
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+
+
+# Binary wire format for messages, ciphertext and IVs travel as raw bytes
+MSGPACK = "application/msgpack"
+JSON = "application/json"
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = MSGPACK
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return msgpack.packb(data, use_bin_type=True)
+
+
+class MessagePackParser(BaseParser):
+    media_type = MSGPACK
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except (msgpack.ExtraData, msgpack.FormatError, ValueError):
+            raise ParseError("Malformed MessagePack body.")
+
+
+def wants_msgpack(request):
+    """True when Accept prefers MessagePack, JSON wins ties and */*"""
+    return request.get_preferred_type([JSON, MSGPACK]) == MSGPACK
+
+
+def negotiated_response(request, data, status=200):
+    """JsonResponse or MessagePack response for plain Django views"""
+    if wants_msgpack(request):
+        response = HttpResponse(
+            msgpack.packb(data, use_bin_type=True), content_type=MSGPACK, status=status
+        )
+    else:
+        response = JsonResponse(data, status=status, safe=False)
+    patch_vary_headers(response, ["Accept"])
+    return response
@@ -1,7 +1,12 @@
+import base64
+import binascii
+
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
 from rest_framework import serializers
-from .models import FriendRequest, User, Message
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from .models import ConversationSummary, FriendRequest, User, Message
+from .tokens import CachedBlacklistRefreshToken
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -23,6 +28,19 @@ class UserSerializer(serializers.ModelSerializer):
         return user
 
 
+class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """Tokens carry name and has_key so identity checks need no lookup"""
+
+    token_class = CachedBlacklistRefreshToken
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token["name"] = user.get_username()
+        token["has_key"] = user.has_key()
+        return token
+
+
 class FriendSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -37,9 +55,86 @@ class FriendRequestSerializer(serializers.ModelSerializer):
         model = FriendRequest
         fields = ["id", "sender", "receiver", "status", "created_at"]
 
+class Base64BinaryField(serializers.Field):
+    """Bytes as base64 text, or raw when the context asks for binary output.
+
+    Accepts base64 text (JSON, forms) or raw bytes (MessagePack).
+    """
+
+    default_error_messages = {
+        "invalid": "Enter valid base64.",
+        "blank": "This field may not be blank.",
+        "max_length": "Ensure this field has no more than {max_length} bytes.",
+    }
+
+    def __init__(self, max_length=None, **kwargs):
+        self.max_length = max_length
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if isinstance(data, str):
+            try:
+                data = base64.b64decode(data, validate=True)
+            except (binascii.Error, ValueError):
+                self.fail("invalid")
+        elif not isinstance(data, bytes):
+            self.fail("invalid")
+        if not data:
+            self.fail("blank")
+        if self.max_length is not None and len(data) > self.max_length:
+            self.fail("max_length", max_length=self.max_length)
+        return data
+
+    def to_representation(self, value):
+        # PostgreSQL hands BinaryField values back as memoryview
+        value = bytes(value)
+        if self.context.get("binary"):
+            return value
+        return base64.b64encode(value).decode()
+
+
 class MessageSerializer(serializers.ModelSerializer):
     sender = FriendSerializer(read_only=True)
     receiver = FriendSerializer(read_only=True)
+    content = Base64BinaryField()
+    iv = Base64BinaryField(max_length=48)
     class Meta:
         model = Message
         fields = ["id", "sender", "receiver", "content", "timestamp", "iv"]
+
+
+class CompactMessageSerializer(serializers.ModelSerializer):
+    """Message without nested users, senders are sent once as participants"""
+
+    sender_id = serializers.IntegerField(read_only=True)
+    content = Base64BinaryField()
+    iv = Base64BinaryField(max_length=48)
+
+    class Meta:
+        model = Message
+        fields = ["id", "sender_id", "content", "timestamp", "iv"]
+
+
+class ConversationSerializer(serializers.ModelSerializer):
+    """A conversation summary seen from context["user_id"]'s side"""
+
+    user = serializers.SerializerMethodField()
+    unread = serializers.SerializerMethodField()
+    read_id = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ConversationSummary
+        fields = ["conversation", "user", "last_message_id", "last_timestamp", "unread", "read_id"]
+
+    def is_user1(self, summary):
+        return summary.user1_id == self.context["user_id"]
+
+    def get_user(self, summary):
+        other = summary.user2 if self.is_user1(summary) else summary.user1
+        return {"id": other.id, "username": other.username}
+
+    def get_unread(self, summary):
+        return summary.user1_unread if self.is_user1(summary) else summary.user2_unread
+
+    def get_read_id(self, summary):
+        return summary.user1_read_id if self.is_user1(summary) else summary.user2_read_id
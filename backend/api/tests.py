@@ -1,3 +1,1685 @@
-from django.test import TestCase
+import asyncio
+import base64
+import importlib
+import json
+import os
+import runpy
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+import msgpack
+import redis
+from asgiref.sync import sync_to_async
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.test import (
+    Client,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, URLResolver, get_resolver
+from django.utils import timezone
+from fakeredis.aioredis import FakeRedis as FakeAsyncRedis
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import audit, jobs, metrics, ratelimit, realtime, utils, views
+from .audit import LoginAttemptBuffer
+from .benchmark import random_public_key
+from .hashing import BoundedExecutor
+from .models import (
+    ConversationSummary,
+    FriendRequest,
+    FriendShip,
+    LoginAttempt,
+    Message,
+    public_key_fingerprint,
+)
+from .querybudget import QueryBudgetExceeded, max_queries, query_shape, record_queries
+from .ratelimit import ALLOWED, BANNED, LIMITED, check_rate_limit
+from .renderers import MSGPACK
+from .serializers import CustomTokenObtainPairSerializer
+from .tokens import (
+    BLACKLIST_READY_KEY,
+    BLACKLIST_READY_TTL,
+    CachedBlacklistRefreshToken,
+    blacklist_key,
+)
+from .usercache import user_cache
+
+
+User = get_user_model()
+
+# Most queries one request to each URL name may run, as exercised by
+# EndpointQueryBudgetTests. Every named route in backend/urls.py needs an
+# entry, raise one only together with the change that needs it
+QUERY_BUDGETS = {
+    "register": 3,
+    "get_token": 2,
+    "refresh_token": 1,
+    "auth_check": 0,
+    "logout": 7,
+    "friend_list": 2,
+    "friends_overview": 2,
+    "send_friendrequest": 8,
+    "respond_friendrequest": 3,
+    "friendrequests_view": 1,
+    "friendrequests_sent_view": 1,
+    "del_friend": 3,
+    "update_user": 4,
+    "message": 4,
+    "message_wait": 1,
+    "conversation_list": 2,
+    "conversation_read": 4,
+    "message_batch": 4,
+    "message_purge_status": 1,
+    "metrics": 0,
+    "admin:api_friendrequest_changelist": 5,
+    "admin:api_friendship_changelist": 5,
+}
+
+PASSWORD = "Query-budget-password-1"
+CIPHERTEXT = "Y2lwaGVydGV4dA=="
+IV = "aXZpdml2aXZpdml2"
+
+
+# No Redis server needed: the cache is in process, direct Redis use goes to
+# fakeredis (FakeRedisMixin), hashing is cheap. Request work stays on the
+# thread that holds the test's transaction
+test_settings = override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    REQUEST_THREAD_POOL=None,
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    METRICS={"token": "test-metrics-token", "flush_interval": 3600, "worker_ttl": 7200},
+)
+
+
+class FakeRedisMixin:
+    """Points get_redis() and the WebSocket hub at an in-memory fakeredis
+    server, emptied before every test along with the cache"""
+
+    @classmethod
+    def setUpClass(cls):
+        server = fakeredis.FakeServer()
+        pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection, server=server)
+
+        class AsyncRedis(FakeAsyncRedis):
+            @classmethod
+            def from_url(cls, url, **kwargs):
+                return cls(server=server)
+
+        for patcher in [
+            mock.patch.object(utils, "_redis_pool", pool),
+            mock.patch.object(ratelimit, "_script", None),
+            mock.patch.object(realtime, "_hub", None),
+            mock.patch.object(realtime.aioredis, "Redis", AsyncRedis),
+            # Tests reuse ids, users must not outlive one
+            mock.patch.object(user_cache, "local_ttl", 0),
+        ]:
+            patcher.start()
+            cls.addClassCleanup(patcher.stop)
+        super().setUpClass()
+
+    def setUp(self):
+        super().setUp()
+        self.redis = utils.get_redis()
+        self.redis.flushall()
+        cache.clear()
+
+
+def named_routes(patterns, namespace=None):
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            if pattern.namespace is None:
+                yield from named_routes(pattern.url_patterns, namespace)
+        elif isinstance(pattern, URLPattern) and pattern.name:
+            yield f"{namespace}:{pattern.name}" if namespace else pattern.name
+
+
+def log_in(client, user):
+    """Token cookies for user, as set by a login"""
+    refresh = CustomTokenObtainPairSerializer.get_token(user)
+    client.cookies["access_token"] = str(refresh.access_token)
+    client.cookies["refresh_token"] = str(refresh)
+    return refresh
+
+
+@test_settings
+class QueryShapeTests(FakeRedisMixin, TestCase):
+    def test_literals_and_in_lists_fold(self):
+        self.assertEqual(
+            query_shape("SELECT * FROM t WHERE id = 4 AND name = 'it''s' AND x IN (%s, %s)"),
+            query_shape("SELECT * FROM t WHERE id = 17 AND name = 'b' AND x IN (%s, %s, %s)"),
+        )
+
+    def test_lazy_load_per_row_is_flagged(self):
+        users = [
+            User.objects.create_user(username=f"shape{index}", password=PASSWORD)
+            for index in range(4)
+        ]
+        for sender, receiver in zip(users, users[1:]):
+            FriendRequest.objects.create(sender=sender, receiver=receiver)
+
+        with self.assertRaisesMessage(QueryBudgetExceeded, "N+1"):
+            with max_queries(10):
+                [str(friend_request) for friend_request in FriendRequest.objects.all()]
+
+        with max_queries(1):
+            [
+                str(friend_request)
+                for friend_request in FriendRequest.objects.select_related("sender", "receiver")
+            ]
+
+    def test_budget_is_enforced(self):
+        with record_queries() as log:
+            User.objects.count()
+            User.objects.exists()
+        self.assertEqual(len(log), 2)
+        self.assertTrue(log.problems("block", budget=1))
+        self.assertFalse(log.problems("block", budget=2))
+
+
+# Above test_settings, the outer decorator wins
+@override_settings(
+    REQUEST_THREAD_POOL={"max_workers": 2, "max_pending": 8}
+)
+@test_settings
+@override_settings(
+    QUERY_BUDGET={
+        "enabled": True,
+        "strict": True,
+        "repeat_threshold": 3,
+        "budgets": QUERY_BUDGETS,
+    },
+)
+class EndpointQueryBudgetTests(FakeRedisMixin, TransactionTestCase):
+    """Each endpoint against QUERY_BUDGETS with enough rows that a lazy
+    load per row would show up as an N+1.
+
+    Transactions are real here, so requests run on the request threads as in
+    production and their queries still count.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(
+            username="alice", password=PASSWORD, e2ee_public_key=random_public_key()
+        )
+        self.friends = [
+            User.objects.create_user(
+                username=f"friend{index}", password=PASSWORD, e2ee_public_key=random_public_key()
+            )
+            for index in range(4)
+        ]
+        self.others = [
+            User.objects.create_user(username=f"other{index}", password=PASSWORD)
+            for index in range(6)
+        ]
+        self.staff = User.objects.create_superuser(username="staff", password=PASSWORD)
+        for user in [self.user, *self.friends, *self.others]:
+            user_cache.invalidate(user.id)
+        for friend in self.friends:
+            FriendShip.objects.create(user1=self.user, user2=friend)
+        self.received = [
+            FriendRequest.objects.create(sender=other, receiver=self.user)
+            for other in self.others[:3]
+        ]
+        for other in self.others[3:]:
+            FriendRequest.objects.create(sender=self.user, receiver=other)
+        self.messages = [
+            Message.objects.create(
+                sender=sender, receiver=receiver, content=b"ciphertext", iv=b"ivivivivivivivi"
+            )
+            for sender, receiver in [(self.user, self.friends[0]), (self.friends[0], self.user)] * 3
+        ]
+        # Saving above warmed the caches, requests start cold
+        cache.clear()
+        for user in [self.user, *self.friends, *self.others, self.staff]:
+            user_cache.invalidate(user.id)
+
+        log_in(self.client, self.user)
+
+    def test_every_named_route_has_a_budget(self):
+        routes = set(named_routes(get_resolver().url_patterns))
+        self.assertEqual(routes - set(QUERY_BUDGETS), set())
+
+    def test_accounts(self):
+        client = self.client_class(REMOTE_ADDR="192.0.2.10")
+        response = client.post(
+            "/api/user/register/", {"username": "newuser", "password": PASSWORD}
+        )
+        self.assertEqual(response.status_code, 201)
+        response = client.post("/api/token/", {"username": "alice", "password": PASSWORD})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.post("/api/token/refresh/").status_code, 200)
+        self.assertEqual(self.client.get("/api/auth-check/").status_code, 200)
+        response = self.client.post(
+            "/api/user/update/", {"update_what": "first_name", "value": "Alice"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.post("/api/user/logout/").status_code, 200)
+
+    def test_friends(self):
+        self.assertEqual(len(self.client.get("/api/friends/").json()), 4)
+        overview = self.client.get("/api/friends/overview/").json()
+        self.assertEqual((len(overview["received"]), len(overview["sent"])), (3, 3))
+        self.assertEqual(len(self.client.get("/api/friendrequest/view/").json()), 3)
+        self.assertEqual(len(self.client.get("/api/friendrequest/sent/").json()), 3)
+
+    def test_friend_changes(self):
+        response = self.client.post("/api/friendrequest/send/", {"receiver": "staff"})
+        self.assertEqual(response.status_code, 201)
+        response = self.client.post(
+            f"/api/friendrequest/respond/{self.received[0].id}/", {"action": "accept"}
+        )
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post("/api/friend/delete/", {"friend": "friend1"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_messages(self):
+        friend = self.friends[0]
+        response = self.client.get("/api/message/", {"with": friend.id, "limit": 50})
+        self.assertEqual(len(response.json()["results"]), 6)
+        response = self.client.get(
+            "/api/message/wait/", {"with": friend.id, "after": 0, "timeout": 0}
+        )
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(
+            "/api/message/", {"receiver_id": friend.id, "content": CIPHERTEXT, "iv": IV}
+        )
+        self.assertEqual(response.status_code, 201)
+        batch = {
+            "messages": [
+                {"receiver_id": friend.id, "content": CIPHERTEXT, "iv": IV}
+                for _ in range(5)
+            ]
+        }
+        response = self.client.post("/api/message/batch/", batch, content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.client.get("/api/message/delete/missing/").status_code, 404)
+
+    def test_conversations(self):
+        self.assertEqual(len(self.client.get("/api/conversations/").json()), 1)
+        response = self.client.post(
+            f"/api/conversations/{self.friends[0].id}/read/",
+            {"message_id": self.messages[-1].id},
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_metrics(self):
+        response = self.client.get(
+            "/metrics/", headers={"Authorization": "Bearer test-metrics-token"}
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_admin_lists(self):
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get("/notadmin/api/friendrequest/").status_code, 200)
+        self.assertEqual(self.client.get("/notadmin/api/friendship/").status_code, 200)
+
+
+@test_settings
+class FriendShipTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username="alice", password=PASSWORD)
+        self.bob = User.objects.create_user(username="bob", password=PASSWORD)
+        self.carol = User.objects.create_user(username="carol", password=PASSWORD)
+
+    def test_save_stores_the_lower_id_first(self):
+        friendship = FriendShip.objects.create(user1=self.bob, user2=self.alice)
+        self.assertEqual((friendship.user1_id, friendship.user2_id), (self.alice.id, self.bob.id))
+        self.assertTrue(FriendShip.objects.filter(user1=self.alice, user2=self.bob).exists())
+        self.assertTrue(FriendShip.are_friends(self.bob.id, self.alice.id))
+
+    def test_reversed_pair_is_rejected_by_the_database(self):
+        # Both skip save()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            FriendShip.objects.bulk_create([FriendShip(user1=self.bob, user2=self.alice)])
+
+        friendship = FriendShip.objects.create(user1=self.alice, user2=self.bob)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            FriendShip.objects.filter(pk=friendship.pk).update(
+                user1=self.carol, user2=self.alice
+            )
+
+    def test_accept_and_delete_refresh_cached_friend_ids(self):
+        FriendShip.objects.create(user1=self.alice, user2=self.bob)
+        friend_request = FriendRequest.objects.create(sender=self.carol, receiver=self.alice)
+        # Cached before the changes
+        self.assertEqual(FriendShip.get_friend_ids(self.alice.id), {self.bob.id})
+        self.assertEqual(FriendShip.get_friend_ids(self.carol.id), set())
+        log_in(self.client, self.alice)
+
+        response = self.client.post(
+            f"/api/friendrequest/respond/{friend_request.id}/", {"action": "accept"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(FriendShip.get_friend_ids(self.alice.id), {self.bob.id, self.carol.id})
+        self.assertEqual(FriendShip.get_friend_ids(self.carol.id), {self.alice.id})
+
+        response = self.client.post("/api/friend/delete/", {"friend": "bob"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(FriendShip.get_friend_ids(self.alice.id), {self.carol.id})
+        self.assertEqual(FriendShip.get_friend_ids(self.bob.id), set())
+
+
+@test_settings
+class FriendsOverviewTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.clients = {}
+        for name in ["alice", "bob", "carol", "dave", "erin"]:
+            user = User.objects.create_user(username=name, password=PASSWORD)
+            setattr(self, name, user)
+            self.clients[name] = Client()
+            log_in(self.clients[name], user)
+        FriendShip.objects.create(user1=self.alice, user2=self.bob)
+        FriendRequest.objects.create(sender=self.alice, receiver=self.carol)
+        FriendRequest.objects.create(sender=self.dave, receiver=self.alice)
+        # Not alice's
+        FriendRequest.objects.create(sender=self.bob, receiver=self.erin)
+
+    def overview(self, etag=None):
+        headers = {"If-None-Match": etag} if etag else {}
+        return self.clients["alice"].get("/api/friends/overview/", headers=headers)
+
+    @staticmethod
+    def directions(requests):
+        return [(item["sender"]["username"], item["receiver"]["username"]) for item in requests]
+
+    def test_lists(self):
+        data = self.overview().json()
+        self.assertEqual([friend["username"] for friend in data["friends"]], ["bob"])
+        self.assertEqual(self.directions(data["received"]), [("dave", "alice")])
+        self.assertEqual(self.directions(data["sent"]), [("alice", "carol")])
+
+    def test_etag_follows_requests(self):
+        etag = self.overview()["ETag"]
+        self.assertEqual(self.overview(etag).status_code, 304)
+
+        response = self.clients["alice"].post("/api/friendrequest/send/", {"receiver": "erin"})
+        self.assertEqual(response.status_code, 201)
+        response = self.overview(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["sent"]), 2)
+        etag = response["ETag"]
+
+        friend_request = FriendRequest.objects.get(sender=self.alice, receiver=self.erin)
+        response = self.clients["erin"].post(
+            f"/api/friendrequest/respond/{friend_request.id}/", {"action": "accept"}
+        )
+        self.assertEqual(response.status_code, 200)
+        response = self.overview(etag)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(
+            sorted(friend["username"] for friend in data["friends"]), ["bob", "erin"]
+        )
+        self.assertEqual([item["receiver"]["username"] for item in data["sent"]], ["carol"])
+
+
+@test_settings
+class MessageHistoryTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="alice", password=PASSWORD)
+        self.friend = User.objects.create_user(username="bob", password=PASSWORD)
+        self.ids = [
+            Message.objects.create(
+                sender=sender, receiver=receiver, content=b"ciphertext", iv=b"ivivivivivivivi"
+            ).id
+            for sender, receiver in [(self.user, self.friend), (self.friend, self.user)] * 3
+        ]
+        log_in(self.client, self.user)
+
+    def page(self, **params):
+        response = self.client.get("/api/message/", {"with": self.friend.id, **params})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [message["id"] for message in data["results"]], data
+
+    def test_latest_page_then_older(self):
+        ids, data = self.page(limit=4)
+        self.assertEqual(ids, self.ids[2:])
+        self.assertEqual(
+            (data["previous"], data["next"], data["has_more"]), (self.ids[2], self.ids[-1], True)
+        )
+
+        ids, data = self.page(before=data["previous"], limit=4)
+        self.assertEqual(ids, self.ids[:2])
+        self.assertFalse(data["has_more"])
+
+        ids, data = self.page(before=self.ids[0])
+        self.assertEqual((ids, data["previous"], data["has_more"]), ([], None, False))
+
+    def test_newer_after_cursor(self):
+        ids, data = self.page(after=self.ids[0], limit=3)
+        self.assertEqual(ids, self.ids[1:4])
+        self.assertTrue(data["has_more"])
+
+        ids, data = self.page(after=data["next"], limit=3)
+        self.assertEqual(ids, self.ids[4:])
+        self.assertFalse(data["has_more"])
+
+        # Nothing newer, next stays put for the following poll
+        ids, data = self.page(after=self.ids[-1])
+        self.assertEqual((ids, data["next"], data["has_more"]), ([], self.ids[-1], False))
+
+    def test_default_page_size(self):
+        with mock.patch("api.views.MESSAGE_PAGE_SIZE", 4):
+            ids, data = self.page()
+        self.assertEqual(ids, self.ids[2:])
+        self.assertEqual((data["previous"], data["has_more"]), (self.ids[2], True))
+
+    def test_limit_is_capped(self):
+        with mock.patch("api.views.MESSAGE_PAGE_SIZE_MAX", 2):
+            ids, data = self.page(limit=500)
+        self.assertEqual(ids, self.ids[-2:])
+        self.assertTrue(data["has_more"])
+
+    def test_invalid_cursor(self):
+        for params in [
+            {"after": "latest"},
+            {"before": "1.5"},
+            {"limit": 0},
+            {"after": self.ids[0], "before": self.ids[-1]},
+        ]:
+            with self.subTest(params=params):
+                response = self.client.get("/api/message/", {"with": self.friend.id, **params})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {"detail": "Invalid cursor."})
+
+
+@test_settings
+class CompactPayloadTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(
+            username="alice", password=PASSWORD, e2ee_public_key=random_public_key()
+        )
+        self.friend = User.objects.create_user(
+            username="bob", password=PASSWORD, e2ee_public_key=random_public_key()
+        )
+        for sender, receiver in [(self.user, self.friend), (self.friend, self.user)] * 2:
+            Message.objects.create(
+                sender=sender, receiver=receiver, content=b"ciphertext", iv=b"ivivivivivivivi"
+            )
+        log_in(self.client, self.user)
+
+    def assertCompact(self, data):
+        self.assertEqual(
+            sorted(data["participants"], key=lambda user: user["id"]),
+            [
+                {"id": user.id, "username": user.username, "e2ee_public_key": user.e2ee_public_key}
+                for user in [self.user, self.friend]
+            ],
+        )
+        self.assertEqual(len(data["results"]), 4)
+        for message in data["results"]:
+            self.assertEqual(set(message), {"id", "sender_id", "content", "iv", "timestamp"})
+            self.assertIn(message["sender_id"], {self.user.id, self.friend.id})
+            self.assertEqual(base64.b64decode(message["content"]), b"ciphertext")
+            self.assertEqual(base64.b64decode(message["iv"]), b"ivivivivivivivi")
+
+    def test_history(self):
+        response = self.client.get("/api/message/", {"with": self.friend.id, "compact": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertCompact(response.json())
+
+        # Without ?compact= every message still carries both users
+        response = self.client.get("/api/message/", {"with": self.friend.id})
+        data = response.json()
+        self.assertNotIn("participants", data)
+        self.assertEqual(data["results"][0]["sender"]["username"], "alice")
+
+    def test_wait(self):
+        response = self.client.get(
+            "/api/message/wait/", {"with": self.friend.id, "after": 0, "compact": "true"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertCompact(response.json())
+
+
+@test_settings
+class MessageWaitTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="alice", password=PASSWORD)
+        self.friend = User.objects.create_user(username="bob", password=PASSWORD)
+        self.other = User.objects.create_user(username="carol", password=PASSWORD)
+        self.last_id = Message.objects.create(
+            sender=self.friend, receiver=self.user, content=b"ciphertext", iv=b"ivivivivivivivi"
+        ).id
+        log_in(self.async_client, self.user)
+
+    def wait(self, **params):
+        return self.async_client.get(
+            "/api/message/wait/", {"with": self.friend.id, "after": self.last_id, **params}
+        )
+
+    async def until_subscribed(self):
+        channel = realtime.user_channel(self.user.id)
+        for _ in range(500):
+            if realtime._hub is not None and realtime._hub.queues.get(channel):
+                return
+            await asyncio.sleep(0.01)
+        self.fail("The wait never subscribed")
+
+    async def send(self, sender):
+        message = await Message.objects.acreate(
+            sender=sender, receiver=self.user, content=b"ciphertext", iv=b"ivivivivivivivi"
+        )
+        # on_commit doesn't fire inside the test's transaction
+        await sync_to_async(realtime.publish_message)(message)
+        return message
+
+    async def test_woken_by_message_from_the_other_user(self):
+        waiter = asyncio.create_task(self.wait(timeout=10))
+        await self.until_subscribed()
+
+        # Another conversation doesn't end the wait
+        await self.send(self.other)
+        await asyncio.sleep(0.1)
+        self.assertFalse(waiter.done())
+
+        message = await self.send(self.friend)
+        response = await asyncio.wait_for(waiter, 5)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([result["id"] for result in data["results"]], [message.id])
+        self.assertEqual(data["next"], message.id)
+        self.assertEqual(realtime._hub.queues, {})
+
+    async def test_timeout_answers_empty(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        response = await self.wait(timeout=0.2)
+        self.assertGreaterEqual(loop.time() - started, 0.2)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data["results"], data["next"]), ([], self.last_id))
+
+    async def test_invalid_parameters(self):
+        for params in [{"timeout": "nan"}, {"timeout": "inf"}, {"after": "latest"}]:
+            with self.subTest(params=params):
+                response = await self.wait(**params)
+                self.assertEqual(response.status_code, 400)
+
+
+class WebSocket:
+    """Drives realtime.websocket_application the way the ASGI server does"""
+
+    def __init__(self, origin=None, cookie=None):
+        origin = settings.CSRF_TRUSTED_ORIGINS[0] if origin is None else origin
+        headers = [(b"origin", origin.encode())]
+        if cookie:
+            headers.append((b"cookie", cookie.encode()))
+        self.incoming = asyncio.Queue()
+        self.sent = asyncio.Queue()
+        scope = {"type": "websocket", "path": realtime.WEBSOCKET_PATH, "headers": headers}
+        self.app = asyncio.create_task(
+            realtime.websocket_application(scope, self.incoming.get, self.sent.put)
+        )
+
+    async def connect(self):
+        await self.incoming.put({"type": "websocket.connect"})
+        return await self.receive()
+
+    async def receive(self):
+        return await asyncio.wait_for(self.sent.get(), 5)
+
+    async def disconnect(self):
+        await self.incoming.put({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.wait_for(self.app, 5)
+
+
+@test_settings
+class RealtimeTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="alice", password=PASSWORD)
+        self.friend = User.objects.create_user(username="bob", password=PASSWORD)
+        FriendShip.objects.create(user1=self.user, user2=self.friend)
+        self.token = str(CustomTokenObtainPairSerializer.get_token(self.user).access_token)
+
+    def send_message(self):
+        client = Client()
+        log_in(client, self.friend)
+        # The message is published once the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(
+                "/api/message/", {"receiver_id": self.user.id, "content": CIPHERTEXT, "iv": IV}
+            )
+        self.assertEqual(response.status_code, 201)
+        return Message.objects.latest("id").id
+
+    async def test_cookie_auth_and_fan_out(self):
+        socket = WebSocket(cookie=f"access_token={self.token}")
+        self.assertEqual(await socket.connect(), {"type": "websocket.accept"})
+
+        message_id = await sync_to_async(self.send_message)()
+        event = await socket.receive()
+        self.assertEqual(event["type"], "websocket.send")
+        envelope = json.loads(event["text"])
+        self.assertEqual(envelope["type"], "message")
+        keys = ["id", "sender_id", "receiver_id", "content"]
+        self.assertEqual(
+            {key: envelope["message"][key] for key in keys},
+            {
+                "id": message_id,
+                "sender_id": self.friend.id,
+                "receiver_id": self.user.id,
+                "content": CIPHERTEXT,
+            },
+        )
+
+        await socket.disconnect()
+        self.assertEqual(realtime._hub.queues, {})
+        self.assertEqual(self.redis.pubsub_numsub(realtime.user_channel(self.user.id)), [
+            (realtime.user_channel(self.user.id).encode(), 0)
+        ])
+
+    async def test_missing_or_invalid_token(self):
+        for cookie in [None, "access_token=not-a-token", f"refresh_token={self.token}"]:
+            with self.subTest(cookie=cookie):
+                socket = WebSocket(cookie=cookie)
+                self.assertEqual(
+                    await socket.connect(), {"type": "websocket.close", "code": 4401}
+                )
+                await asyncio.wait_for(socket.app, 5)
+
+    async def test_untrusted_origin(self):
+        for origin in ["https://evil.example", ""]:
+            with self.subTest(origin=origin):
+                socket = WebSocket(origin=origin, cookie=f"access_token={self.token}")
+                self.assertEqual(
+                    await socket.connect(), {"type": "websocket.close", "code": 4403}
+                )
+                await asyncio.wait_for(socket.app, 5)
+        # Rejected before subscribing
+        self.assertEqual(getattr(realtime._hub, "queues", {}), {})
+
+
+@test_settings
+class ConditionalGetTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(
+            username="alice", password=PASSWORD, e2ee_public_key=random_public_key()
+        )
+        self.friend = User.objects.create_user(
+            username="bob", password=PASSWORD, e2ee_public_key=random_public_key()
+        )
+        FriendShip.objects.create(user1=self.user, user2=self.friend)
+        log_in(self.client, self.user)
+
+    def assertRevalidates(self, path, params=None):
+        """GETs path, checks that its ETag earns a 304 and returns the ETag"""
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+
+        response = self.client.get(path, params, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response["ETag"], etag)
+        return etag
+
+    def assertChanged(self, path, etag, params=None):
+        response = self.client.get(path, params, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_friend_list(self):
+        etag = self.assertRevalidates("/api/friends/")
+        other = User.objects.create_user(username="carol", password=PASSWORD)
+        FriendShip.objects.create(user1=self.user, user2=other)
+        self.assertChanged("/api/friends/", etag)
+
+    def test_friend_list_after_key_change(self):
+        etag = self.assertRevalidates("/api/friends/")
+        self.friend.e2ee_public_key = random_public_key()
+        self.friend.save()
+        self.assertChanged("/api/friends/", etag)
+
+    def test_friend_requests(self):
+        etag = self.assertRevalidates("/api/friendrequest/view/")
+        other = User.objects.create_user(username="carol", password=PASSWORD)
+        FriendRequest.objects.create(sender=other, receiver=self.user)
+        self.assertChanged("/api/friendrequest/view/", etag)
+
+    def test_deleted_friend(self):
+        friends_etag = self.assertRevalidates("/api/friends/")
+        other = User.objects.create_user(username="carol", password=PASSWORD)
+        FriendRequest.objects.create(sender=self.friend, receiver=other)
+        log_in(self.client, other)
+        requests_etag = self.assertRevalidates("/api/friendrequest/view/")
+        # Cached by the friend list above
+        self.assertEqual(FriendShip.get_friend_ids(self.user.id), {self.friend.id})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.friend.delete()
+
+        self.assertEqual(FriendShip.get_friend_ids(self.user.id), set())
+        self.assertChanged("/api/friendrequest/view/", requests_etag)
+        log_in(self.client, self.user)
+        self.assertChanged("/api/friends/", friends_etag)
+        self.assertEqual(self.client.get("/api/friends/").json(), [])
+
+    def test_message_history(self):
+        params = {"with": self.friend.id, "limit": 50}
+        etag = self.assertRevalidates("/api/message/", params)
+        response = self.client.post(
+            "/api/message/", {"receiver_id": self.friend.id, "content": CIPHERTEXT, "iv": IV}
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertChanged("/api/message/", etag, params)
+
+    def test_etag_is_per_representation(self):
+        params = {"with": self.friend.id, "limit": 50}
+        etag = self.assertRevalidates("/api/message/", params)
+        response = self.client.get(
+            "/api/message/", params,
+            headers={"If-None-Match": etag, "Accept": "application/msgpack"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+@test_settings
+class ConversationTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.clients = {}
+        for name in ["alice", "bob", "carol", "dave"]:
+            user = User.objects.create_user(username=name, password=PASSWORD)
+            setattr(self, name, user)
+            self.clients[name] = Client()
+            log_in(self.clients[name], user)
+
+    def send(self, sender, receiver):
+        response = self.clients[sender.username].post(
+            "/api/message/", {"receiver_id": receiver.id, "content": CIPHERTEXT, "iv": IV}
+        )
+        self.assertEqual(response.status_code, 201)
+        return Message.objects.latest("id").id
+
+    def conversations(self, user):
+        response = self.clients[user.username].get("/api/conversations/")
+        self.assertEqual(response.status_code, 200)
+        return {item["user"]["username"]: item for item in response.json()}
+
+    def read(self, user, other, **data):
+        return self.clients[user.username].post(
+            f"/api/conversations/{other.id}/read/", data, content_type="application/json"
+        )
+
+    def test_unread_counts_from_each_side(self):
+        self.send(self.alice, self.bob)
+        self.send(self.alice, self.bob)
+        last_id = self.send(self.bob, self.alice)
+
+        bob = self.conversations(self.bob)["alice"]
+        alice = self.conversations(self.alice)["bob"]
+        self.assertEqual((bob["unread"], bob["read_id"], bob["last_message_id"]), (2, 0, last_id))
+        self.assertEqual((alice["unread"], alice["read_id"]), (1, 0))
+
+        response = self.read(self.bob, self.alice)
+        self.assertEqual(response.json(), {"unread": 0, "read_id": last_id})
+        self.assertEqual(self.conversations(self.bob)["alice"]["unread"], 0)
+        self.assertEqual(self.conversations(self.alice)["bob"]["unread"], 1)
+
+    def test_read_marker(self):
+        first_id = self.send(self.alice, self.bob)
+        last_id = self.send(self.alice, self.bob)
+
+        # message_id=0 is a valid id that reads nothing
+        self.assertEqual(
+            self.read(self.bob, self.alice, message_id=0).json(), {"unread": 2, "read_id": 0}
+        )
+        self.assertEqual(
+            self.read(self.bob, self.alice, message_id=first_id).json(),
+            {"unread": 1, "read_id": first_id},
+        )
+        # Clamped to the newest message
+        self.assertEqual(
+            self.read(self.bob, self.alice, message_id=last_id + 100).json(),
+            {"unread": 0, "read_id": last_id},
+        )
+        self.assertEqual(self.read(self.bob, self.alice, message_id="x").status_code, 400)
+
+    def test_read_marker_of_someone_elses_conversation(self):
+        self.send(self.alice, self.bob)
+        self.assertEqual(self.read(self.carol, self.alice).status_code, 404)
+        self.assertEqual(self.read(self.carol, self.bob).status_code, 404)
+        self.assertEqual(self.conversations(self.bob)["alice"]["unread"], 1)
+
+    def test_list_order_and_etag(self):
+        self.send(self.bob, self.alice)
+        self.send(self.carol, self.alice)
+        self.send(self.dave, self.bob)
+        client = self.clients["alice"]
+
+        response = client.get("/api/conversations/")
+        self.assertEqual([item["user"]["username"] for item in response.json()], ["carol", "bob"])
+        etag = response["ETag"]
+        response = client.get("/api/conversations/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        # Another user's conversation doesn't change alice's list
+        self.send(self.dave, self.carol)
+        response = client.get("/api/conversations/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        # A new message moves its conversation to the top
+        self.send(self.bob, self.alice)
+        response = client.get("/api/conversations/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item["user"]["username"] for item in response.json()], ["bob", "carol"])
+
+
+@test_settings
+class MessageBatchTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="alice", password=PASSWORD)
+        self.friend = User.objects.create_user(username="bob", password=PASSWORD)
+        log_in(self.client, self.user)
+
+    def send(self, items):
+        return self.client.post(
+            "/api/message/batch/", {"messages": items}, content_type="application/json"
+        )
+
+    def message(self, receiver_id):
+        return {"receiver_id": receiver_id, "content": CIPHERTEXT, "iv": IV}
+
+    def test_mixed_batch(self):
+        response = self.send([
+            self.message(self.friend.id),
+            self.message("bob"),
+            self.message(self.friend.id + 1000),
+            {"receiver_id": self.friend.id, "content": "not base64!", "iv": IV},
+            self.message(self.friend.id),
+        ])
+        self.assertEqual(response.status_code, 207)
+        results = response.json()["results"]
+        self.assertEqual([result["status"] for result in results], [201, 400, 404, 400, 201])
+        self.assertIn("content", results[3]["errors"])
+
+        stored = Message.objects.filter(sender=self.user).order_by("id")
+        self.assertEqual(
+            list(stored.values_list("id", flat=True)), [results[0]["id"], results[4]["id"]]
+        )
+        summary = ConversationSummary.objects.get(conversation=stored[0].conversation)
+        self.assertEqual(summary.last_message_id, results[4]["id"])
+        self.assertEqual(summary.read_state(self.friend.id), (0, 2))
+
+    def test_all_valid(self):
+        response = self.send([self.message(self.friend.id) for _ in range(3)])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Message.objects.count(), 3)
+
+    def test_nothing_valid_stores_nothing(self):
+        response = self.send([self.message("bob"), self.message(self.friend.id + 1000)])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            [result["status"] for result in response.json()["results"]], [400, 404]
+        )
+        self.assertFalse(Message.objects.exists())
+
+    def test_batch_size(self):
+        self.assertEqual(self.send([]).status_code, 400)
+        with mock.patch("api.views.MESSAGE_BATCH_MAX", 2):
+            response = self.send([self.message(self.friend.id) for _ in range(3)])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Message.objects.exists())
+
+
+@test_settings
+class MessagePurgeTests(FakeRedisMixin, TransactionTestCase):
+    """Purges run on the real executor thread, so transactions are real"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="alice", password=PASSWORD)
+        self.friend = User.objects.create_user(username="bob", password=PASSWORD)
+        self.other = User.objects.create_user(username="carol", password=PASSWORD)
+        for sender, receiver in [(self.user, self.friend), (self.friend, self.user)] * 3:
+            self.send(sender, receiver)
+        self.kept = self.send(self.friend, self.other)
+        log_in(self.client, self.user)
+
+        # Record the stored status at every heartbeat, one per batch
+        self.statuses = []
+        heartbeat = jobs.heartbeat
+
+        def record_status(job):
+            heartbeat(job)
+            self.statuses.append(jobs.get_job(job["id"])["status"])
+
+        for patcher in [
+            mock.patch.object(jobs, "PURGE_BATCH_SIZE", 2),
+            mock.patch.object(jobs, "PURGE_BATCH_PAUSE", 0),
+            mock.patch.object(jobs, "heartbeat", record_status),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def send(self, sender, receiver):
+        return Message.objects.create(
+            sender=sender, receiver=receiver, content=b"ciphertext", iv=b"ivivivivivivivi"
+        )
+
+    def job(self):
+        return self.client.get(f"/api/message/delete/{self.job_id}/").json()
+
+    def hold_submits(self):
+        """Patches the executor to hold submitted purges until run_held()"""
+        self.held = []
+        return mock.patch.object(jobs._executor, "submit", lambda *args: self.held.append(args))
+
+    def run_held(self):
+        # SQLite would lock out writes made here while a purge runs
+        for args in self.held:
+            jobs._executor.submit(*args).result(timeout=10)
+
+    def start(self):
+        with self.hold_submits():
+            response = self.client.delete("/api/message/")
+        self.assertEqual(response.status_code, 202)
+        self.job_id = response.json()["job_id"]
+        # Sent after the request, not part of the purge
+        self.late = self.send(self.friend, self.user)
+        self.run_held()
+        return response.json()["status"]
+
+    def test_pending_running_done(self):
+        self.assertEqual(self.start(), "pending")
+        self.assertEqual(len(self.held), 1)
+        # Once on start, then after each of the three batches
+        self.assertEqual(self.statuses, ["running"] * 4)
+        self.assertEqual(self.job(), {"job_id": self.job_id, "status": "done", "deleted": 6})
+        self.assertEqual(
+            set(Message.objects.values_list("id", flat=True)), {self.kept.id, self.late.id}
+        )
+        summary = ConversationSummary.objects.get(conversation=self.late.conversation)
+        self.assertEqual(summary.last_message_id, self.late.id)
+        self.assertEqual(summary.read_state(self.user.id), (0, 1))
+        self.assertFalse(self.redis.smembers(jobs.ACTIVE_JOBS_KEY))
+
+    def test_orphaned_job_is_resumed(self):
+        # The worker takes the lease and dies before running the job
+        with mock.patch.object(jobs._executor, "submit"):
+            response = self.client.delete("/api/message/")
+        self.job_id = response.json()["job_id"]
+        self.assertEqual(self.job()["status"], "pending")
+        self.assertFalse(jobs.resume_message_purge(jobs.get_job(self.job_id)))
+
+        # Its lease runs out, the next worker to start takes the job over
+        cache.delete(jobs.lease_key(self.job_id))
+        with self.hold_submits():
+            jobs.resume_stale_purges()
+        self.assertEqual(len(self.held), 1)
+        self.run_held()
+        self.assertEqual(self.job()["status"], "done")
+        self.assertEqual(list(Message.objects.values_list("id", flat=True)), [self.kept.id])
+
+    def test_nothing_to_delete(self):
+        Message.objects.all().delete()
+        self.assertEqual(self.start(), "done")
+        self.assertEqual(self.held, [])
+
+
+@test_settings
+class MetricsTests(FakeRedisMixin, TestCase):
+    AUTHORIZATION = {"Authorization": "Bearer test-metrics-token"}
+
+    def scrape(self):
+        response = self.client.get("/metrics/", headers=self.AUTHORIZATION)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        return response.content.decode()
+
+    @staticmethod
+    def sample(text, series):
+        """Value of one series in an exposition, 0 when it isn't there yet"""
+        for line in text.splitlines():
+            name, _, value = line.rpartition(" ")
+            if name == series:
+                return float(value)
+        return 0
+
+    def test_token(self):
+        for headers in [
+            {},
+            {"Authorization": "Bearer wrong-token"},
+            {"Authorization": "Basic test-metrics-token"},
+        ]:
+            with self.subTest(headers=headers):
+                self.assertEqual(self.client.get("/metrics/", headers=headers).status_code, 403)
+        with override_settings(METRICS={**settings.METRICS, "token": ""}):
+            response = self.client.get("/metrics/", headers=self.AUTHORIZATION)
+            self.assertEqual(response.status_code, 404)
+
+    def test_request_is_recorded(self):
+        user = User.objects.create_user(username="alice", password=PASSWORD)
+        log_in(self.client, user)
+        get = 'route="friend_list",method="GET"'
+        series = {
+            "ok": f'http_requests_total{{{get},status="200"}}',
+            "denied": f'http_requests_total{{{get},status="401"}}',
+            "latency": f"http_request_duration_seconds_count{{{get}}}",
+            "slowest": f'http_request_duration_seconds_bucket{{{get},le="+Inf"}}',
+            "requests": 'db_queries_per_request_count{route="friend_list"}',
+            "queries": 'db_queries_per_request_sum{route="friend_list"}',
+        }
+        before = self.scrape()
+
+        self.assertEqual(self.client.get("/api/friends/").status_code, 200)
+        self.assertEqual(Client().get("/api/friends/").status_code, 401)
+
+        after = self.scrape()
+        delta = {
+            name: self.sample(after, line) - self.sample(before, line)
+            for name, line in series.items()
+        }
+        self.assertEqual(
+            {name: delta[name] for name in ["ok", "denied", "latency", "slowest", "requests"]},
+            {"ok": 1, "denied": 1, "latency": 2, "slowest": 2, "requests": 2},
+        )
+        # The user and the friend list were loaded from the database
+        self.assertGreaterEqual(delta["queries"], 2)
+
+    def test_workers_are_summed(self):
+        series = 'http_requests_total{route="elsewhere",method="GET",status="200"}'
+        counts = {"worker-1": 2, "worker-2": 3, "stopped": 100}
+        for worker, count in counts.items():
+            worker_snapshot = {
+                # The stopped worker's snapshot is older than worker_ttl
+                "time": 0 if worker == "stopped" else time.time(),
+                "metrics": {"http_requests_total": [[["elsewhere", "GET", "200"], count]]},
+            }
+            self.redis.hset(metrics.WORKERS_KEY, worker, json.dumps(worker_snapshot))
+
+        self.assertEqual(self.sample(self.scrape(), series), 5)
+        self.assertFalse(self.redis.hexists(metrics.WORKERS_KEY, "stopped"))
+        # This worker's own snapshot is stored for the others
+        self.assertTrue(self.redis.hexists(metrics.WORKERS_KEY, metrics.worker_id()))
+
+
+@test_settings
+@override_settings(
+    RATE_LIMITS={
+        "login": {"limit": 3, "window": 60},
+        "register": {"limit": 2, "window": 60},
+    },
+    RATE_LIMIT_BAN_DURATIONS=[60, 600, 1800],
+)
+class RateLimitTests(FakeRedisMixin, TestCase):
+    IP = "192.0.2.1"
+
+    def statuses(self, count, scope="login", ip=IP):
+        return [check_rate_limit(scope, ip).status for _ in range(count)]
+
+    def end_ban(self, scope="login"):
+        self.redis.delete(f"ban:{scope}:{self.IP}")
+
+    def test_allows_then_limits_then_bans(self):
+        self.assertEqual(self.statuses(3), [ALLOWED] * 3)
+        self.assertEqual(check_rate_limit("login", self.IP), (LIMITED, 60))
+        status, retry_after = check_rate_limit("login", self.IP)
+        self.assertEqual(status, BANNED)
+        self.assertTrue(0 < retry_after <= 60)
+        self.assertEqual(self.redis.ttl(f"rate_hits:login:{self.IP}"), -2)
+
+    def test_hits_expire_with_the_window(self):
+        self.statuses(2)
+        self.assertTrue(0 < self.redis.ttl(f"rate_hits:login:{self.IP}") <= 60)
+        self.redis.delete(f"rate_hits:login:{self.IP}")
+        self.assertEqual(self.statuses(3), [ALLOWED] * 3)
+
+    def test_ban_escalates(self):
+        durations = []
+        for _ in range(4):
+            self.assertEqual(self.statuses(3), [ALLOWED] * 3)
+            status, retry_after = check_rate_limit("login", self.IP)
+            self.assertEqual(status, LIMITED)
+            durations.append(retry_after)
+            self.end_ban()
+        # Stays at the longest ban once the list runs out
+        self.assertEqual(durations, [60, 600, 1800, 1800])
+
+        # Violations are forgotten after RATE_LIMIT_VIOLATION_TTL
+        self.redis.delete(f"rate_violation:login:{self.IP}")
+        self.statuses(3)
+        self.assertEqual(check_rate_limit("login", self.IP), (LIMITED, 60))
+
+    def test_scopes_and_addresses_are_separate(self):
+        self.statuses(4)
+        self.assertEqual(check_rate_limit("login", self.IP).status, BANNED)
+        self.assertEqual(self.statuses(2, scope="register"), [ALLOWED] * 2)
+        self.assertEqual(self.statuses(3, ip="192.0.2.2"), [ALLOWED] * 3)
+
+    def test_register_endpoint(self):
+        for index in range(2):
+            response = self.client.post(
+                "/api/user/register/", {"username": f"user{index}", "password": PASSWORD}
+            )
+            self.assertEqual(response.status_code, 201)
+        response = self.client.post(
+            "/api/user/register/", {"username": "user2", "password": PASSWORD}
+        )
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "60")
+        self.assertFalse(User.objects.filter(username="user2").exists())
+
+
+@test_settings
+class LoginTests(FakeRedisMixin, TransactionTestCase):
+    """Real transactions, the password check runs on the hashing pool's thread"""
+
+    def setUp(self):
+        super().setUp()
+        User.objects.create_user(username="alice", password=PASSWORD)
+
+    def test_json_and_form_logins(self):
+        credentials = {"username": "alice", "password": PASSWORD}
+        response = self.client.post("/api/token/", credentials, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()), {"access", "refresh"})
+        self.assertIn("access_token", response.cookies)
+        self.assertIn("csrftoken", response.cookies)
+
+        response = self.client.post("/api/token/", {**credentials, "password": "wrong"})
+        self.assertEqual(response.status_code, 401)
+        self.assertIn("detail", response.json())
+        self.assertEqual(self.client.post("/api/token/", {"username": "alice"}).status_code, 400)
+
+    def test_full_hashing_pool_answers_503(self):
+        pool = BoundedExecutor(max_workers=1, max_pending=0, name="test-hash")
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        # Takes the only slot until released
+        holder = threading.Thread(target=asyncio.run, args=(pool.arun(block),))
+        with mock.patch.object(views, "password_hashing", pool):
+            holder.start()
+            self.assertTrue(started.wait(5))
+            try:
+                response = self.client.post(
+                    "/api/token/", {"username": "alice", "password": PASSWORD}
+                )
+            finally:
+                release.set()
+                holder.join()
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response["Retry-After"], "1")
+
+            response = self.client.post("/api/token/", {"username": "alice", "password": PASSWORD})
+            self.assertEqual(response.status_code, 200)
+
+
+@test_settings
+class AuthCheckTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="alice", password=PASSWORD)
+
+    def auth_check(self):
+        response = self.client.get("/api/auth-check/")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_answered_from_claims(self):
+        log_in(self.client, self.user)
+        with mock.patch.object(user_cache, "get") as get, self.assertNumQueries(0):
+            data = self.auth_check()
+        get.assert_not_called()
+        self.assertEqual(data, {"name": "alice", "id": self.user.id, "has_key": False})
+
+    def test_tokens_without_claims_use_the_cached_user(self):
+        # Issued before the name and has_key claims existed
+        self.client.cookies["access_token"] = str(AccessToken.for_user(self.user))
+        self.user.e2ee_public_key = random_public_key()
+        self.user.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.auth_check(), {"name": "alice", "id": self.user.id, "has_key": True}
+            )
+        # Now cached
+        with self.assertNumQueries(0):
+            self.auth_check()
+
+    def test_key_change_reissues_tokens(self):
+        old_refresh = str(log_in(self.client, self.user))
+        response = self.client.post(
+            "/api/user/update/",
+            {"update_what": "e2ee_public_key", "value": random_public_key()},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+
+        with self.assertRaisesMessage(TokenError, "Token is blacklisted"):
+            CachedBlacklistRefreshToken(old_refresh)
+        access = AccessToken(response.cookies["access_token"].value)
+        self.assertTrue(access["has_key"])
+        refresh = CachedBlacklistRefreshToken(response.cookies["refresh_token"].value)
+        self.assertTrue(refresh["has_key"])
+        # The client now sends the new cookies
+        with self.assertNumQueries(0):
+            self.assertTrue(self.auth_check()["has_key"])
+
+
+@test_settings
+class UserCacheInvalidationTests(FakeRedisMixin, TestCase):
+    """Changes to a user reach the next authenticated request, not a cached copy"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="alice", password=PASSWORD)
+        self.refresh = log_in(self.client, self.user)
+        self.assertFriendsStatus(200)
+        # Later requests authenticate from the cache
+        self.assertIsNotNone(cache.get(f"auth_user:{self.user.id}:{self.cached_version()}"))
+
+    def cached_version(self):
+        return cache.get(user_cache.version_key(self.user.id))
+
+    def assertFriendsStatus(self, status):
+        self.assertEqual(self.client.get("/api/friends/").status_code, status)
+
+    def deactivate_behind_the_cache(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {User._meta.db_table} SET is_active = %s WHERE id = %s",
+                [False, self.user.id],
+            )
+
+    def test_save(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertFriendsStatus(401)
+
+    def test_queryset_update(self):
+        User.objects.filter(username="alice").update(is_active=False)
+        self.assertFriendsStatus(401)
+
+    def test_queryset_delete(self):
+        User.objects.filter(username="alice").delete()
+        self.assertFriendsStatus(401)
+
+    def test_logout(self):
+        self.deactivate_behind_the_cache()
+        self.assertFriendsStatus(200)
+        self.assertEqual(self.client.post("/api/user/logout/").status_code, 200)
+        # The access token itself is still valid until it expires
+        self.client.cookies["access_token"] = str(self.refresh.access_token)
+        self.assertFriendsStatus(401)
+
+
+@test_settings
+class LoginAttemptBufferTests(TestCase):
+    def buffer(self, max_size=10, overflow="sync"):
+        buffer = LoginAttemptBuffer(
+            max_size=max_size, batch_size=2, flush_interval=1.0, overflow=overflow
+        )
+        # Flushed from the test's thread instead, which holds its transaction
+        patcher = mock.patch.object(buffer, "_start_worker")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return buffer
+
+    def record(self, buffer, username, at):
+        with mock.patch.object(audit.timezone, "now", return_value=at):
+            buffer.record(username=username, ip_address="10.0.0.1", success=username == "alice")
+
+    def stored(self):
+        return list(LoginAttempt.objects.order_by("id").values_list("username", "timestamp"))
+
+    def test_flush_keeps_the_time_of_each_attempt(self):
+        buffer = self.buffer()
+        started = timezone.now() - timedelta(minutes=5)
+        for index, username in enumerate(["alice", "mallory", "alice"]):
+            self.record(buffer, username, started + timedelta(seconds=index))
+        self.assertEqual(self.stored(), [])
+
+        # Two batches
+        with CaptureQueriesContext(connection) as queries:
+            buffer.flush()
+        self.assertEqual(sum("INSERT" in query["sql"] for query in queries), 2)
+        self.assertEqual(
+            self.stored(),
+            [
+                ("alice", started),
+                ("mallory", started + timedelta(seconds=1)),
+                ("alice", started + timedelta(seconds=2)),
+            ],
+        )
+        self.assertEqual(LoginAttempt.objects.filter(success=False).count(), 1)
+
+    def test_full_buffer_writes_inline_with_sync(self):
+        buffer = self.buffer(max_size=1, overflow="sync")
+        now = timezone.now()
+        self.record(buffer, "alice", now)
+        self.record(buffer, "mallory", now + timedelta(seconds=1))
+        self.assertEqual(self.stored(), [("mallory", now + timedelta(seconds=1))])
+
+        buffer.flush()
+        self.assertEqual(
+            sorted(self.stored()), [("alice", now), ("mallory", now + timedelta(seconds=1))]
+        )
+        self.assertEqual(buffer.dropped, 0)
+
+    def test_full_buffer_drops_with_drop(self):
+        buffer = self.buffer(max_size=1, overflow="drop")
+        now = timezone.now()
+        with self.assertLogs("api.audit", "WARNING"):
+            for username in ["alice", "mallory", "eve"]:
+                self.record(buffer, username, now)
+        self.assertEqual(self.stored(), [])
+        self.assertEqual(buffer.dropped, 2)
+
+        buffer.flush()
+        self.assertEqual(self.stored(), [("alice", now)])
+
+
+@test_settings
+class TokenBlacklistMirrorTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="alice", password=PASSWORD)
+        self.refresh = log_in(self.client, self.user)
+        self.jti = self.refresh["jti"]
+        call_command("compact_token_blacklist", stdout=StringIO())
+
+    def assertRejected(self, queries):
+        with max_queries(queries) as log:
+            with self.assertRaisesMessage(TokenError, "Token is blacklisted"):
+                CachedBlacklistRefreshToken(str(self.refresh))
+        return log
+
+    def test_logout_blacklists_in_redis(self):
+        self.assertEqual(self.client.post("/api/user/logout/").status_code, 200)
+        self.assertTrue(BlacklistedToken.objects.filter(token__jti=self.jti).exists())
+        self.assertTrue(self.redis.exists(blacklist_key(self.jti)))
+
+        self.assertRejected(queries=0)
+        self.client.cookies["refresh_token"] = str(self.refresh)
+        response = self.client.post("/api/token/refresh/")
+        self.assertEqual(response.status_code, 401)
+
+    def test_mirror_is_trusted_once_ready(self):
+        # Only in Redis, so the SQL check would let it through
+        self.redis.set(blacklist_key(self.jti), 1)
+        self.assertRejected(queries=0)
+
+        self.redis.delete(blacklist_key(self.jti))
+        with max_queries(0):
+            CachedBlacklistRefreshToken(str(self.refresh))
+
+    def test_falls_back_to_sql_until_ready(self):
+        self.refresh.blacklist()
+        self.redis.delete(BLACKLIST_READY_KEY, blacklist_key(self.jti))
+        log = self.assertRejected(queries=1)
+        self.assertEqual(len(log), 1)
+
+    def test_compaction_rebuilds_the_mirror(self):
+        token = OutstandingToken.objects.get(jti=self.jti)
+        BlacklistedToken.objects.create(token=token)
+        self.redis.flushall()
+
+        call_command("compact_token_blacklist", stdout=StringIO())
+        # Kept until the token would have expired, the marker for one interval
+        lifetime = self.refresh.lifetime.total_seconds()
+        self.assertTrue(0 < self.redis.ttl(blacklist_key(self.jti)) <= lifetime)
+        self.assertTrue(0 < self.redis.ttl(BLACKLIST_READY_KEY) <= BLACKLIST_READY_TTL)
+        self.assertRejected(queries=0)
+
+
+@test_settings
+class BinaryCiphertextTests(FakeRedisMixin, TestCase):
+    # Not valid UTF-8, would not survive being sent as text
+    CONTENT = bytes(range(256))
+    IV_BYTES = b"\x00\xff" * 6
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="alice", password=PASSWORD)
+        self.friend = User.objects.create_user(username="bob", password=PASSWORD)
+        log_in(self.client, self.user)
+
+    def history(self, **headers):
+        response = self.client.get(
+            "/api/message/", {"with": self.friend.id, "limit": 50}, headers=headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Accept", response["Vary"])
+        return response
+
+    def test_base64_round_trip(self):
+        body = {
+            "receiver_id": self.friend.id,
+            "content": base64.b64encode(self.CONTENT).decode(),
+            "iv": base64.b64encode(self.IV_BYTES).decode(),
+        }
+        response = self.client.post("/api/message/", body)
+        self.assertEqual(response.status_code, 201)
+        message = Message.objects.get()
+        self.assertEqual(bytes(message.content), self.CONTENT)
+        self.assertEqual(bytes(message.iv), self.IV_BYTES)
+
+        [sent] = self.history().json()["results"]
+        self.assertEqual(base64.b64decode(sent["content"]), self.CONTENT)
+        self.assertEqual(base64.b64decode(sent["iv"]), self.IV_BYTES)
+
+    def test_msgpack_round_trip(self):
+        body = {"receiver_id": self.friend.id, "content": self.CONTENT, "iv": self.IV_BYTES}
+        response = self.client.post(
+            "/api/message/", msgpack.packb(body, use_bin_type=True), content_type=MSGPACK
+        )
+        self.assertEqual(response.status_code, 201)
+        message = Message.objects.get()
+        self.assertEqual(bytes(message.content), self.CONTENT)
+        self.assertEqual(bytes(message.iv), self.IV_BYTES)
+
+        response = self.history(Accept=MSGPACK)
+        self.assertEqual(response["Content-Type"], MSGPACK)
+        [sent] = msgpack.unpackb(response.content, raw=False)["results"]
+        self.assertEqual((sent["content"], sent["iv"]), (self.CONTENT, self.IV_BYTES))
+        # The same row as JSON
+        [sent] = self.history().json()["results"]
+        self.assertEqual(sent["content"], base64.b64encode(self.CONTENT).decode())
+
+    def test_msgpack_batch(self):
+        body = {
+            "messages": [
+                {"receiver_id": self.friend.id, "content": self.CONTENT, "iv": self.IV_BYTES},
+                {"receiver_id": self.friend.id, "content": 12, "iv": self.IV_BYTES},
+            ]
+        }
+        response = self.client.post(
+            "/api/message/batch/",
+            msgpack.packb(body, use_bin_type=True),
+            content_type=MSGPACK,
+            headers={"Accept": MSGPACK},
+        )
+        self.assertEqual(response.status_code, 207)
+        first, second = msgpack.unpackb(response.content, raw=False)["results"]
+        self.assertEqual(bytes(Message.objects.get(id=first["id"]).content), self.CONTENT)
+        self.assertEqual(second["errors"], {"content": ["Enter valid base64."]})
+
+    def test_invalid_ciphertext(self):
+        for body in [
+            {"content": b"", "iv": self.IV_BYTES},
+            {"content": self.CONTENT, "iv": b"x" * 49},
+            {"content": "not base64!", "iv": self.IV_BYTES},
+        ]:
+            with self.subTest(body=body):
+                response = self.client.post(
+                    "/api/message/",
+                    msgpack.packb({"receiver_id": self.friend.id, **body}, use_bin_type=True),
+                    content_type=MSGPACK,
+                )
+                self.assertEqual(response.status_code, 400)
+        response = self.client.post("/api/message/", b"\xc1", content_type=MSGPACK)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Message.objects.exists())
+
+
+class SQLiteWALTests(SimpleTestCase):
+    """The sqlite_wal database profile on a scratch file, next to the test database"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with mock.patch.dict(os.environ, {"DB_ENGINE": "sqlite_wal"}):
+            path = importlib.import_module(settings.SETTINGS_MODULE).__file__
+            profile = runpy.run_path(path)["DATABASES"]["default"]
+        directory = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(directory.cleanup)
+        profile = {**profile, "NAME": Path(directory.name) / "db.sqlite3"}
+        connections.settings["wal"] = connections.configure_settings({"default": profile})[
+            "default"
+        ]
+        cls.addClassCleanup(connections.settings.pop, "wal")
+        # Allowed only now, the test runner's checks don't know the alias
+        cls.databases = {*cls.databases, "wal"}
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(self.close)
+
+    @staticmethod
+    def close():
+        connections["wal"].close()
+
+    def pragma(self, name):
+        with connections["wal"].cursor() as cursor:
+            cursor.execute(f"PRAGMA {name}")
+            return cursor.fetchone()[0]
+
+    def test_pragmas(self):
+        self.assertEqual(connections["wal"].settings_dict["ENGINE"], "backend.sqlite_wal")
+        self.assertEqual(self.pragma("journal_mode"), "wal")
+        self.assertEqual(self.pragma("busy_timeout"), 20000)
+        self.assertEqual(self.pragma("synchronous"), 1)  # NORMAL
+
+    def test_concurrent_writers(self):
+        with connections["wal"].cursor() as cursor:
+            cursor.execute("CREATE TABLE entry (id INTEGER PRIMARY KEY, writer TEXT)")
+        barrier = threading.Barrier(2)
+        errors = []
+
+        def write(writer):
+            try:
+                barrier.wait(5)
+                for _ in range(5):
+                    # Read then write, the pattern that fails when two
+                    # deferred transactions both try to upgrade
+                    with transaction.atomic(using="wal"), connections["wal"].cursor() as cursor:
+                        cursor.execute("SELECT COUNT(*) FROM entry")
+                        time.sleep(0.01)
+                        cursor.execute("INSERT INTO entry (writer) VALUES (%s)", [writer])
+                    # Autocommit write
+                    with connections["wal"].cursor() as cursor:
+                        cursor.execute("INSERT INTO entry (writer) VALUES (%s)", [writer])
+            except Exception as error:
+                errors.append(error)
+            finally:
+                self.close()
+
+        threads = [threading.Thread(target=write, args=(name,)) for name in ["a", "b"]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(errors, [])
+        with connections["wal"].cursor() as cursor:
+            cursor.execute("SELECT writer, COUNT(*) FROM entry GROUP BY writer ORDER BY writer")
+            self.assertEqual(cursor.fetchall(), [("a", 10), ("b", 10)])
+
+
+@test_settings
+class PublicKeyTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.key = random_public_key()
+        self.owner = User.objects.create_user(
+            username="alice", password=PASSWORD, e2ee_public_key=self.key
+        )
+        self.user = User.objects.create_user(username="bob", password=PASSWORD)
+
+    def test_duplicate_key_is_rejected(self):
+        log_in(self.client, self.user)
+        response = self.client.post(
+            "/api/user/update/",
+            {"update_what": "e2ee_public_key", "value": {**self.key, "key_ops": ["deriveKey"]}},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Public key already in use", response.json()["detail"])
+        self.user.refresh_from_db()
+        self.assertIsNone(self.user.e2ee_public_key)
+        self.assertFalse(self.user.has_key())
+
+    def fingerprint_lookups(self, user):
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        return [
+            query["sql"]
+            for query in queries
+            if query["sql"].startswith("SELECT") and "e2ee_key_fingerprint" in query["sql"]
+        ]
+
+    def test_unchanged_key_skips_the_fingerprint_query(self):
+        owner = User.objects.get(pk=self.owner.pk)
+        owner.first_name = "Alice"
+        self.assertEqual(self.fingerprint_lookups(owner), [])
+
+        # A new key is checked against the others
+        owner.e2ee_public_key = random_public_key()
+        self.assertEqual(len(self.fingerprint_lookups(owner)), 1)
+        self.assertTrue(owner.has_key())
+
+    def test_backfill_clears_duplicate_and_invalid_keys(self):
+        backfill = importlib.import_module(
+            "api.migrations.0005_user_e2ee_key_fingerprint"
+        ).backfill_fingerprint
+        # Rows as they were before fingerprints, bypassing clean(). The same
+        # key with other metadata passes the column's unique constraint
+        User.objects.filter(pk=self.user.pk).update(
+            e2ee_public_key={**self.key, "key_ops": ["deriveKey"]}
+        )
+        broken = User.objects.create_user(username="carol", password=PASSWORD)
+        User.objects.filter(pk=broken.pk).update(e2ee_public_key={"kty": "EC"})
+        User.objects.update(e2ee_key_fingerprint=None)
+
+        with self.assertLogs(backfill.__module__, "WARNING"):
+            backfill(django_apps, None)
+
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.e2ee_key_fingerprint, public_key_fingerprint(self.key))
+        for user in [self.user, broken]:
+            user.refresh_from_db()
+            self.assertIsNone(user.e2ee_public_key)
+            self.assertFalse(user.has_key())
@@ -0,0 +1,70 @@
+import functools
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+
+from .hashing import BoundedExecutor, PoolOverloaded
+
+_request_threads = None
+
+
+# Under ASGI, Django runs sync code (sync views, the async ORM, cache.a*) on a
+# single thread per process, so one slow query stalls the whole worker.
+# Request work runs on this pool instead, each thread with its own database
+# connection
+def get_request_threads():
+    global _request_threads
+    if _request_threads is None:
+        _request_threads = BoundedExecutor(name="request", **settings.REQUEST_THREAD_POOL)
+    return _request_threads
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Await a blocking call, e.g. ORM or cache work, without holding the event loop.
+
+    Raises PoolOverloaded when every thread and pending slot is taken.
+    """
+    if settings.REQUEST_THREAD_POOL is None:
+        # Django's thread sensitive thread, tests need it to share their transaction
+        return await sync_to_async(fn)(*args, **kwargs)
+    return await get_request_threads().arun(fn, *args, **kwargs)
+
+
+def server_busy():
+    return JsonResponse(
+        {"detail": "Server busy, try again shortly."}, status=503, headers={"Retry-After": "1"}
+    )
+
+
+def sheds_load(view):
+    """Answer PoolOverloaded from an async view with a 503"""
+
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            return await view(request, *args, **kwargs)
+        except PoolOverloaded:
+            return server_busy()
+
+    return wrapper
+
+
+def call_view(view, request, *args, **kwargs):
+    response = view(request, *args, **kwargs)
+    # Encoded here instead of on the thread sensitive thread, Django's own
+    # render call then finds it done
+    if hasattr(response, "render"):
+        response.render()
+    return response
+
+
+def in_thread_pool(view):
+    """A sync view, e.g. a DRF one, served from the request threads"""
+
+    @sheds_load
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        return await run_blocking(call_view, view, request, *args, **kwargs)
+
+    return wrapper
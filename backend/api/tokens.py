@@ -0,0 +1,62 @@
+from datetime import datetime, timezone
+
+import redis
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .utils import get_redis
+
+
+# Set once the mirror holds every blacklisted token that hasn't expired. If
+# Redis loses its data the marker goes too and checks fall back to SQL until
+# compact_token_blacklist has mirrored the table again. The marker expires
+# after one compaction interval, so a mirror that lost keys any other way
+# (eviction, a missed write) is only trusted until the next rebuild.
+BLACKLIST_READY_KEY = "token_blacklist:ready"
+BLACKLIST_READY_TTL = 3600
+
+
+def blacklist_key(jti):
+    return f"token_blacklist:{jti}"
+
+
+def mirror_blacklisted(client, jti, exp):
+    """Store a blacklisted jti in Redis until the token would expire anyway"""
+    remaining = int(exp - datetime.now(timezone.utc).timestamp())
+    if remaining > 0:
+        client.set(blacklist_key(jti), 1, ex=remaining)
+
+
+class CachedBlacklistRefreshToken(RefreshToken):
+    """RefreshToken whose blacklist check is a Redis lookup.
+
+    The token_blacklist tables stay the source of truth, blacklisting writes
+    them first and then mirrors the jti into Redis.
+    """
+
+    def check_blacklist(self):
+        jti = self.payload[api_settings.JTI_CLAIM]
+        try:
+            ready, blacklisted = get_redis().mget(BLACKLIST_READY_KEY, blacklist_key(jti))
+        except redis.RedisError:
+            ready = None
+        if not ready:
+            return super().check_blacklist()
+        if blacklisted:
+            raise TokenError(_("Token is blacklisted"))
+
+    def blacklist(self):
+        result = super().blacklist()
+        client = get_redis()
+        try:
+            mirror_blacklisted(client, self.payload[api_settings.JTI_CLAIM], self.payload["exp"])
+        except redis.RedisError:
+            # The mirror is now incomplete, send checks to SQL until the next
+            # compaction run has rebuilt it
+            try:
+                client.delete(BLACKLIST_READY_KEY)
+            except redis.RedisError:
+                pass
+        return result
@@ -0,0 +1,116 @@
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import router
+
+from .threads import run_blocking
+
+
+logger = logging.getLogger(__name__)
+
+# Only what authentication needs is cached, never the password hash. Other
+# fields of a cached user are deferred and load from the database on access
+CACHED_FIELDS = ("id", "username", "is_active", "e2ee_key_fingerprint")
+
+
+class UserCache:
+    """Users resolved for authentication, in an in-process LRU over Redis.
+
+    Redis entries are keyed by user id and a per-user version. Invalidating
+    bumps the version, so a request that loaded the old row can't put it back
+    under the current key. The local tier holds entries for ``local_ttl``
+    seconds, which bounds how long another process may serve a stale user.
+    Both tiers hold CACHED_FIELDS values, every get builds a fresh user.
+    """
+
+    def __init__(self, local_ttl, local_size, redis_ttl):
+        self.local_ttl = local_ttl
+        self.local_size = local_size
+        self.redis_ttl = redis_ttl
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def version_key(user_id):
+        return f"auth_user_version:{user_id}"
+
+    def get_local(self, user_id):
+        """The user from the in-process tier, None when it isn't there or expired"""
+        with self._lock:
+            entry = self._local.get(user_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self._local.move_to_end(user_id)
+                return self.build(entry[0])
+        return None
+
+    def get(self, user_id):
+        """The user with this id, or None if it doesn't exist"""
+        user = self.get_local(user_id)
+        if user is not None:
+            return user
+
+        try:
+            version_key = self.version_key(user_id)
+            version = cache.get(version_key)
+            if version is None:
+                cache.add(version_key, random.getrandbits(48), None)
+                version = cache.get(version_key)
+
+            key = f"auth_user:{user_id}:{version}"
+            values = cache.get(key)
+            if values is None:
+                values = self.load(user_id)
+                if values is None:
+                    return None
+                cache.set(key, values, self.redis_ttl)
+        except Exception:
+            # Redis being down must not lock everyone out
+            values = self.load(user_id)
+            return None if values is None else self.build(values)
+
+        with self._lock:
+            self._local[user_id] = (values, time.monotonic() + self.local_ttl)
+            self._local.move_to_end(user_id)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+        return self.build(values)
+
+    async def aget(self, user_id):
+        """get for async code, only a miss in the local tier takes a thread"""
+        user = self.get_local(user_id)
+        if user is None:
+            user = await run_blocking(self.get, user_id)
+        return user
+
+    @staticmethod
+    def load(user_id):
+        User = get_user_model()
+        try:
+            return User.objects.filter(pk=user_id).values_list(*CACHED_FIELDS).first()
+        except ValueError:
+            return None
+
+    @staticmethod
+    def build(values):
+        User = get_user_model()
+        return User.from_db(router.db_for_read(User), CACHED_FIELDS, tuple(values))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._local.pop(user_id, None)
+        version_key = self.version_key(user_id)
+        try:
+            cache.add(version_key, random.getrandbits(48), None)
+            cache.incr(version_key)
+        except Exception:
+            # Other processes serve the old entry until redis_ttl runs out
+            logger.warning("Could not invalidate cached user %s", user_id, exc_info=True)
+
+
+user_cache = UserCache(**settings.AUTH_USER_CACHE)
@@ -1,5 +1,12 @@
+from django.conf import settings
 from django.middleware.csrf import CsrfViewMiddleware
 from rest_framework.response import Response
+import redis
+
+from .metrics import TimedRedis
+
+_redis_pool = None
+
 
 # Custom csrf check function
 def csrf_check(request):
@@ -7,4 +14,17 @@ def csrf_check(request):
     reason = csrf_middleware.process_view(request, None, (), {})
     if reason:
         return Response({"detail": f"CSRF Failed: {reason}"}, status=403)
-    return None
\ No newline at end of file
+    return None
+
+
+# Redis client on one connection pool shared by the whole process, commands
+# are timed for the metrics
+def get_redis():
+    global _redis_pool
+    if _redis_pool is None:
+        _redis_pool = redis.BlockingConnectionPool.from_url(
+            settings.REDIS_URL,
+            max_connections=settings.REDIS_POOL_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+        )
+    return TimedRedis(connection_pool=_redis_pool)
@@ -2,52 +2,92 @@ from django.shortcuts import get_object_or_404, render
 from django.contrib.auth import get_user_model
 from django.contrib.auth.views import LoginView
 from rest_framework import generics
+from django.db import transaction
 from django.db.models import Q
 from .serializers import (
     FriendRequestSerializer,
     FriendSerializer,
     UserSerializer,
     MessageSerializer,
+    CompactMessageSerializer,
+    ConversationSerializer,
+    CustomTokenObtainPairSerializer,
 )
 from rest_framework.permissions import IsAuthenticated, AllowAny
-from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
-from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.views import TokenRefreshView
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed, ParseError, ValidationError
+from rest_framework.request import Request
 from django.http import HttpResponse, JsonResponse
-from django.utils.decorators import method_decorator
-from django_ratelimit.decorators import ratelimit
-from .models import LoginAttempt, FriendRequest, FriendShip, Message
-from django.contrib.auth import authenticate
+from .models import ConversationSummary, FriendRequest, FriendShip, Message
 from rest_framework.decorators import api_view, permission_classes
-from django.views.decorators.csrf import ensure_csrf_cookie
+from rest_framework.settings import api_settings
+from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
 from .utils import csrf_check
-import time
+from .etags import (
+    aconditional_get,
+    bump,
+    conditional_get,
+    conversations_version,
+    friends_version,
+    messages_version,
+    profile_version,
+    requests_version,
+)
+from .realtime import get_hub, publish_message
+from .jobs import get_job, resume_message_purge, start_message_purge
+from .audit import login_attempts
+from . import metrics
+from .hashing import password_hashing
+from .threads import call_view, run_blocking, sheds_load
+from .ratelimit import BANNED, LIMITED, check_rate_limit
+from .usercache import user_cache
+from .renderers import (
+    MessagePackParser,
+    MessagePackRenderer,
+    negotiated_response,
+    wants_msgpack,
+)
+from .tokens import CachedBlacklistRefreshToken
+from .authentication import (
+    CustomJWTAuthentication,
+    TokenClaimsAuthentication,
+    authenticate_async,
+)
+import asyncio
+import json
+import math
 import redis
 
 
-r = redis.Redis(host="redis", port=6379, db=0)
 User = get_user_model()
 
-
-def handle_violation(request):
-    """Progressive rate limit for failed login attempts"""
-
-    ip = request.META.get("REMOTE_ADDR")
-    key = f"rate_violation:{ip}"
-    count = r.incr(key)
-    r.expire(key, 3600)  # violation expires in one hour
-
-    if count == 1:
-        r.setex(f"ban:{ip}", 60, 1)  # first block for 1 min
-
-    elif count == 2:
-        r.setex(f"ban:{ip}", 600, 1)  # 2nd block for 10 mins
-
-    elif count >= 3:
-        r.setex(f"ban:{ip}", 1800, 1)  # 3rd block for 30 mins
+MESSAGE_PAGE_SIZE = 50
+MESSAGE_PAGE_SIZE_MAX = 200
+MESSAGE_WAIT_TIMEOUT = 25  # seconds
+MESSAGE_WAIT_TIMEOUT_MAX = 60
+MESSAGE_BATCH_MAX = 100
+
+
+def set_token_cookies(response, access_token, refresh_token=None):
+    response.set_cookie(
+        key="access_token",
+        value=access_token,
+        httponly=True,
+        secure=True,  # true for production
+        samesite="Lax",  # Strict?
+    )
+    if refresh_token is not None:
+        response.set_cookie(
+            key="refresh_token",
+            value=refresh_token,
+            httponly=True,
+            secure=True,  # true for production
+            samesite="Lax",
+        )
 
 
 class UpdateUserView(APIView):
@@ -64,7 +104,8 @@ class UpdateUserView(APIView):
         if target_field not in self.allowed_fields:
             return Response({"detail": "Field not allowed to be updated."}, status=403)
         value = request.data.get("value")
-        user = request.user
+        # request.user comes from the auth cache with most fields deferred
+        user = User.objects.get(pk=request.user.pk)
 
         if not hasattr(user, target_field):
             return Response(
@@ -74,23 +115,40 @@ class UpdateUserView(APIView):
         try:
             setattr(user, target_field, value)
             user.save()
-            return Response({"detail": "User info updated."}, status=status.HTTP_200_OK)
         except Exception as e:
             return Response(
                 {"detail": f"User info update failed: {str(e)}"},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+        response = Response({"detail": "User info updated."}, status=status.HTTP_200_OK)
+        if target_field == "e2ee_public_key":
+            # has_key is a token claim, so reissue the tokens and retire the old refresh
+            self.reissue_tokens(request, response, user)
+        return response
+
+    def reissue_tokens(self, request, response, user):
+        old_refresh = request.COOKIES.get("refresh_token")
+        if old_refresh:
+            try:
+                CachedBlacklistRefreshToken(old_refresh).blacklist()
+            except TokenError:
+                pass
+        refresh = CustomTokenObtainPairSerializer.get_token(user)
+        set_token_cookies(response, str(refresh.access_token), str(refresh))
+
 @api_view(["POST"])
 def logout_view(request):
     """Blacklist refresh token after logout"""
     csrf_error = csrf_check(request)
     if csrf_error:
         return csrf_error
+    if request.user.is_authenticated:
+        user_cache.invalidate(request.user.id)
     refresh_token = request.COOKIES.get("refresh_token")
     if refresh_token:
         try:
-            token = RefreshToken(refresh_token)
+            token = CachedBlacklistRefreshToken(refresh_token)
             token.blacklist()
         except TokenError:
             pass
@@ -107,15 +165,13 @@ def logout_view(request):
 class CustomAdminLoginView(LoginView):
     template_name = "admin/login.html"
 
-    @method_decorator(ratelimit(key="ip", rate="5/m", block=False))
     def dispatch(self, request, *args, **kwargs):
-        ip = request.META.get("REMOTE_ADDR")
-        if r.exists(f"ban:{ip}"):
+        limit = check_rate_limit("admin_login", request.META.get("REMOTE_ADDR"))
+        if limit.status == BANNED:
             return JsonResponse(
                 {"error": "Temporarily banned, too many login attempts"}, status=429
             )
-        if getattr(request, "limited", False):
-            handle_violation(request)
+        if limit.status == LIMITED:
             return JsonResponse(
                 {"error": "Too many login attempts. Try again later."}, status=429
             )
@@ -127,74 +183,78 @@ class CreateUserView(generics.CreateAPIView):
     serializer_class = UserSerializer
     permission_classes = [AllowAny]
 
-    @method_decorator(ratelimit(key="ip", rate="15/h", block=True))
     def create(self, request, *args, **kwargs):
-        return super().create(request, *args, **kwargs)
-
-
-@method_decorator(ensure_csrf_cookie, name="post")
-class CustomTokenObtainPairView(TokenObtainPairView):
-    permission_classes = [AllowAny]
-
-    @method_decorator(ratelimit(key="ip", rate="5/m", block=False))
-    def post(self, request, *args, **kwargs):
-        # Check if person is blocked due to too many login attempts
-        ip = request.META.get("REMOTE_ADDR")
-        if r.exists(f"ban:{ip}"):
-            duration = r.expiretime(f"ban:{ip}") - int(time.time())
+        limit = check_rate_limit("register", request.META.get("REMOTE_ADDR"))
+        if not limit.allowed:
             return Response(
-                {
-                    "detail": f"Temporarily banned: too many login attempts, {duration} seconds remaining"
-                },
+                {"detail": "Too many registrations. Try again later."},
                 status=429,
+                headers={"Retry-After": str(limit.retry_after)},
             )
-        # Check if person exceeded the rate limit and handle the violation
-        if getattr(request, "limited", "false"):
-            handle_violation(request)
-            return Response({"detail": "Too many login attempts!"}, status=429)
-
-        # For logging the login attempt:
-        username = request.data.get("username")
-        password = request.data.get("password")
+        return super().create(request, *args, **kwargs)
 
-        user = authenticate(username=username, password=password)
 
-        login_attempt = LoginAttempt(
-            username=username,
-            ip_address=request.META.get("REMOTE_ADDR"),
-            user_env=request.META.get("HTTP_USER_AGENT"),
+@csrf_exempt
+@ensure_csrf_cookie
+@sheds_load
+async def login_view(request):
+    """Password login, sets the token cookies.
+
+    The password check runs on the hashing pool while the request waits
+    without a thread, a full pool answers 503 (sheds_load).
+    """
+    if request.method != "POST":
+        return method_not_allowed()
+
+    # Ban check, rate limit and violation handling in one Redis call
+    limit = await run_blocking(check_rate_limit, "login", request.META.get("REMOTE_ADDR"))
+    if limit.status == BANNED:
+        return JsonResponse(
+            {
+                "detail": f"Temporarily banned: too many login attempts, {limit.retry_after} seconds remaining"
+            },
+            status=429,
         )
+    if limit.status == LIMITED:
+        return JsonResponse({"detail": "Too many login attempts!"}, status=429)
 
-        if user is None:
-            login_attempt.success = False
-            login_attempt.reason = "Invalid credentials"
-            login_attempt.save()
-        else:
-            login_attempt.success = True
-            login_attempt.save()
-
-        # Authentication
-        response = super().post(request, *args, **kwargs)
-
-        if response.status_code == 200:
-            tokens = response.data
+    try:
+        # JSON, form or multipart, as the DRF view accepted
+        parsers = [parser() for parser in api_settings.DEFAULT_PARSER_CLASSES]
+        data = Request(request, parsers=parsers).data
+    except ParseError as e:
+        return JsonResponse({"detail": e.detail}, status=400)
+
+    # Credentials are verified once, the result is both logged and used
+    # to issue the tokens
+    serializer = CustomTokenObtainPairSerializer(data=data, context={"request": request})
+    try:
+        await password_hashing.arun(serializer.is_valid, raise_exception=True)
+    except AuthenticationFailed as e:
+        await run_blocking(log_login_attempt, request, data, success=False)
+        response = JsonResponse({"detail": e.detail}, status=e.status_code)
+        response["WWW-Authenticate"] = CustomJWTAuthentication().authenticate_header(request)
+        return response
+    except ValidationError as e:
+        await run_blocking(log_login_attempt, request, data, success=False)
+        return JsonResponse(e.detail, status=e.status_code)
+    await run_blocking(log_login_attempt, request, data, success=True)
+
+    tokens = serializer.validated_data
+    response = JsonResponse(tokens)
+    set_token_cookies(response, tokens["access"], tokens["refresh"])
+    return response
 
-            response.set_cookie(
-                key="access_token",
-                value=tokens["access"],
-                httponly=True,
-                secure=True,  # true for production
-                samesite="Lax",  # Strict?
-            )
 
-            response.set_cookie(
-                key="refresh_token",
-                value=tokens["refresh"],
-                httponly=True,
-                secure=True,  # true for production
-                samesite="Lax",
-            )
-        return response
+def log_login_attempt(request, data, success):
+    metrics.login_attempts.inc("success" if success else "failure")
+    login_attempts.record(
+        username=data.get("username"),
+        ip_address=request.META.get("REMOTE_ADDR"),
+        user_env=request.META.get("HTTP_USER_AGENT"),
+        success=success,
+        reason=None if success else "Invalid credentials",
+    )
 
 
 class CustomTokenRefreshView(TokenRefreshView):
@@ -207,34 +267,53 @@ class CustomTokenRefreshView(TokenRefreshView):
                 {"detail": "Missing refresh token"}, status=status.HTTP_400_BAD_REQUEST
             )
         try:
-            refresh = RefreshToken(refresh_token)
+            refresh = CachedBlacklistRefreshToken(refresh_token)
             access_token = str(refresh.access_token)
 
             response = Response({"Message": "Token refreshed"})
-            response.set_cookie(
-                key="access_token",
-                value=access_token,
-                httponly=True,
-                secure=True,  # true for production
-                samesite="Lax",
-            )
+            set_token_cookies(response, access_token)
             return response
         except TokenError:
             return Response({"detail": "Invalid refresh token"}, status=401)
 
 
+def not_authenticated(request):
+    response = JsonResponse(
+        {"detail": "Authentication credentials were not provided."}, status=401
+    )
+    response["WWW-Authenticate"] = CustomJWTAuthentication().authenticate_header(request)
+    return response
 
-@method_decorator(ensure_csrf_cookie, name="get")
-class CheckAuthenticationView(APIView):
-    # check if authenticated and get user information
-    permission_classes = [IsAuthenticated]
 
-    def get(self, request):
-        user = request.user
-        return Response(
-            {"name": user.get_username(), "id": user.id, "has_key": user.has_key()},
-            status=status.HTTP_200_OK,
+def method_not_allowed():
+    return JsonResponse({"detail": "Method not allowed."}, status=405)
+
+
+@ensure_csrf_cookie
+@sheds_load
+async def check_authentication_view(request):
+    # check if authenticated and get user information
+    # answered from the token's claims, no database or cache lookup
+    if request.method != "GET":
+        return method_not_allowed()
+
+    # Only verifies the token signature, cheap enough to run on the event loop
+    authenticated = TokenClaimsAuthentication().authenticate(request)
+    if authenticated is None:
+        return not_authenticated(request)
+    token_user, token = authenticated
+
+    if "name" not in token or "has_key" not in token:
+        # Issued before the claims existed
+        user = await user_cache.aget(token_user.id)
+        if user is None:
+            return JsonResponse({"detail": "User not found"}, status=401)
+        return JsonResponse(
+            {"name": user.get_username(), "id": user.id, "has_key": user.has_key()}
         )
+    return JsonResponse(
+        {"name": token["name"], "id": int(token_user.id), "has_key": token["has_key"]}
+    )
 
 
 @api_view(["POST"])
@@ -254,10 +333,8 @@ def delete_friend(request):
         return Response({"detail": "User does not exist."}, status=404)
 
     try:
-        friendship = FriendShip.objects.get(
-            Q(user1=request.user, user2=friend_user)
-            | Q(user1=friend_user, user2=request.user)
-        )
+        user1, user2 = sorted((request.user, friend_user), key=lambda user: user.id)
+        friendship = FriendShip.objects.get(user1=user1, user2=user2)
         friendship.delete()
         return Response({"detail": "Friend removed successfully."}, status=200)
     except FriendShip.DoesNotExist:
@@ -304,10 +381,7 @@ class FriendRequestView(generics.CreateAPIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        if FriendShip.objects.filter(
-            Q(user1=request.user, user2=receiver)
-            | Q(user1=receiver, user2=request.user)
-        ).exists():
+        if FriendShip.are_friends(request.user.id, receiver.id):
             return Response(
                 {"detail": "Friend already exists."},
                 status=status.HTTP_400_BAD_REQUEST,
@@ -322,14 +396,50 @@ class FriendRequestView(generics.CreateAPIView):
         )
 
 
-class FriendListView(APIView):
-    permission_classes = [IsAuthenticated]
+@sheds_load
+async def friend_list_view(request):
+    if request.method != "GET":
+        return method_not_allowed()
+    user = await authenticate_async(request)
+    if user is None:
+        return not_authenticated(request)
 
-    def get(self, request):
-        user = request.user
+    def build_response():
         friends = FriendShip.get_friends(user)
         serializer = FriendSerializer(friends, many=True, read_only=True)
-        return Response(serializer.data)
+        return JsonResponse(serializer.data, safe=False)
+
+    return await aconditional_get(request, [friends_version(user.id)], build_response)
+
+
+@sheds_load
+async def friends_overview_view(request):
+    """Friends, received and sent pending requests for the friends page in one response"""
+    if request.method != "GET":
+        return method_not_allowed()
+    user = await authenticate_async(request)
+    if user is None:
+        return not_authenticated(request)
+
+    def build_response():
+        friends = FriendShip.get_friends(user)
+        # One query for both directions, split here
+        received, sent = [], []
+        for friend_request in FriendRequest.pending_for(user.id):
+            if friend_request.receiver_id == user.id:
+                received.append(friend_request)
+            else:
+                sent.append(friend_request)
+        return JsonResponse(
+            {
+                "friends": FriendSerializer(friends, many=True).data,
+                "received": FriendRequestSerializer(received, many=True).data,
+                "sent": FriendRequestSerializer(sent, many=True).data,
+            }
+        )
+
+    versions = [friends_version(user.id), requests_version(user.id)]
+    return await aconditional_get(request, versions, build_response)
 
 
 class PendingFriendRequestsView(generics.ListAPIView):
@@ -337,8 +447,15 @@ class PendingFriendRequestsView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return FriendRequest.objects.filter(
-            receiver=self.request.user, status="pending"
+        return FriendRequest.pending_for(self.request.user.id).filter(
+            receiver=self.request.user
+        )
+
+    def list(self, request, *args, **kwargs):
+        return conditional_get(
+            request,
+            [requests_version(request.user.id)],
+            lambda: super(PendingFriendRequestsView, self).list(request, *args, **kwargs),
         )
 
 
@@ -347,7 +464,14 @@ class SentFriendRequestsView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return FriendRequest.objects.filter(sender=self.request.user, status="pending")
+        return FriendRequest.pending_for(self.request.user.id).filter(sender=self.request.user)
+
+    def list(self, request, *args, **kwargs):
+        return conditional_get(
+            request,
+            [requests_version(request.user.id)],
+            lambda: super(SentFriendRequestsView, self).list(request, *args, **kwargs),
+        )
 
 
 class RespondToFriendRequestView(APIView):
@@ -378,9 +502,62 @@ class RespondToFriendRequestView(APIView):
             )
 
 
+def get_message_page(messages, params):
+    """Slice a conversation with message id cursors.
+
+    ``after`` returns messages newer than the cursor (oldest first),
+    ``before`` pages backwards from the cursor and no cursor returns the
+    latest page. Raises ValueError on malformed parameters.
+    """
+    query, limit = message_page_query(messages, params)
+    return message_page(list(query), params, limit)
+
+
+def message_page_query(messages, params):
+    """Queryset behind get_message_page, fetches one row past the limit"""
+    after = params.get("after")
+    before = params.get("before")
+    if after is not None and before is not None:
+        raise ValueError("Use either after or before, not both.")
+
+    limit = int(params.get("limit", MESSAGE_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError("Invalid limit.")
+    limit = min(limit, MESSAGE_PAGE_SIZE_MAX)
+
+    if after is not None:
+        return messages.filter(id__gt=int(after)).order_by("id")[: limit + 1], limit
+    if before is not None:
+        messages = messages.filter(id__lt=int(before))
+    # Newest first so the slice is bounded, message_page flips it back
+    return messages.order_by("-id")[: limit + 1], limit
+
+
+def message_page(rows, params, limit):
+    """Page and cursors from the rows of message_page_query"""
+    after = params.get("after")
+    has_more = len(rows) > limit
+    page = rows[:limit]
+    if after is None:
+        page = page[::-1]
+    else:
+        after = int(after)
+
+    cursors = {
+        # pass as ?after= to fetch newer messages
+        "next": page[-1].id if page else after,
+        # pass as ?before= to fetch older messages
+        "previous": page[0].id if page else None,
+        "has_more": has_more,
+    }
+    return page, cursors
+
+
 class MessageView(generics.CreateAPIView):
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated]
+    parser_classes = [*api_settings.DEFAULT_PARSER_CLASSES, MessagePackParser]
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, MessagePackRenderer]
     queryset = Message.objects.all()
 
     def create(self, request, *args, **kwargs):
@@ -392,28 +569,309 @@ class MessageView(generics.CreateAPIView):
         receiver = User.objects.get(id=receiver_id)
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        serializer.save(sender=request.user, receiver=receiver)
+        message = serializer.save(sender=request.user, receiver=receiver)
+        transaction.on_commit(lambda: publish_message(message))
         return Response({"detail": "Message sent!"}, status=status.HTTP_201_CREATED)
     
     def delete(self, request, *args, **kwargs):
         csrf_error = csrf_check(request)
         if csrf_error:
             return csrf_error
-        user = request.user
-        messages = Message.objects.filter(sender=user) | Message.objects.filter(receiver=user)
-        messages.delete()
-        return Response({"detail": "Message history deleted"})
-    
-    def get(self, request, *args, **kwargs):
-        other_user_id = request.query_params.get("with")
-        if not other_user_id:
-            return Response({"detail": "Missing id."}, status=400)
-
-        messages = Message.objects.filter(
-            sender=request.user, receiver__id=other_user_id
-        ) | Message.objects.filter(
-            sender__id=other_user_id, receiver=request.user
+        # Large histories are deleted in batches in the background
+        job = start_message_purge(request.user)
+        return Response(
+            {
+                "detail": "Message history deletion started",
+                "job_id": job["id"],
+                "status": job["status"],
+            },
+            status=status.HTTP_202_ACCEPTED,
         )
-        messages = messages.order_by("timestamp")
-        serializer = self.get_serializer(messages, many=True)
-        return Response(serializer.data)
\ No newline at end of file
+
+
+message_write_view = MessageView.as_view()
+
+
+@csrf_exempt
+@sheds_load
+async def message_view(request):
+    """History reads run async, sends and deletes stay on MessageView"""
+    if request.method == "GET":
+        return await message_history_view(request)
+    # MessageView does its own csrf_check
+    return await run_blocking(call_view, message_write_view, request)
+
+
+async def message_history_view(request):
+    user = await authenticate_async(request)
+    if user is None:
+        return not_authenticated(request)
+
+    other_user_id = request.GET.get("with")
+    if not other_user_id:
+        return JsonResponse({"detail": "Missing id."}, status=400)
+
+    try:
+        conversation = Message.conversation_key(user.id, other_user_id)
+    except ValueError:
+        return JsonResponse({"detail": "Invalid id."}, status=400)
+
+    def build_response():
+        try:
+            data = get_conversation_data(
+                user, other_user_id, request.GET, binary=wants_msgpack(request)
+            )
+        except ValueError:
+            return JsonResponse({"detail": "Invalid cursor."}, status=400)
+        return negotiated_response(request, data)
+
+    versions = [
+        messages_version(conversation),
+        profile_version(user.id),
+        profile_version(other_user_id),
+    ]
+    return await aconditional_get(request, versions, build_response)
+
+
+class MessagePurgeStatusView(APIView):
+    """Progress of a message history deletion started with DELETE /api/message/"""
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id):
+        job = get_job(job_id)
+        if job is None or job["user_id"] != request.user.id:
+            return Response({"detail": "Job not found"}, status=status.HTTP_404_NOT_FOUND)
+        # The worker running it may have died, take it over if its lease ran out
+        resume_message_purge(job)
+        return Response(
+            {"job_id": job["id"], "status": job["status"], "deleted": job["deleted"]}
+        )
+
+
+@sheds_load
+async def conversation_list_view(request):
+    """Every conversation of the user with its last message and unread count"""
+    if request.method != "GET":
+        return method_not_allowed()
+    user = await authenticate_async(request)
+    if user is None:
+        return not_authenticated(request)
+
+    def build_response():
+        summaries = (
+            ConversationSummary.for_user(user.id)
+            .select_related("user1", "user2")
+            .only(
+                *[field.name for field in ConversationSummary._meta.concrete_fields],
+                "user1__username",
+                "user2__username",
+            )
+        )
+        serializer = ConversationSerializer(
+            summaries, many=True, context={"user_id": user.id}
+        )
+        return JsonResponse(serializer.data, safe=False)
+
+    return await aconditional_get(request, [conversations_version(user.id)], build_response)
+
+
+class ConversationReadView(APIView):
+    """Read marker: everything up to message_id (default: the latest) is read"""
+
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, other_user_id):
+        csrf_error = csrf_check(request)
+        if csrf_error:
+            return csrf_error
+
+        message_id = request.data.get("message_id")
+        try:
+            message_id = int(message_id) if message_id is not None else None
+        except (TypeError, ValueError):
+            return Response({"detail": "Invalid message_id."}, status=400)
+
+        conversation = Message.conversation_key(request.user.id, other_user_id)
+        with transaction.atomic():
+            summary = (
+                ConversationSummary.objects.select_for_update()
+                .filter(conversation=conversation)
+                .first()
+            )
+            if summary is None or summary.last_message_id is None:
+                return Response({"detail": "Conversation not found"}, status=404)
+            # Can't read past the newest message
+            if message_id is None:
+                message_id = summary.last_message_id
+            changed = summary.mark_read(request.user.id, min(message_id, summary.last_message_id))
+        if changed:
+            bump(conversations_version(request.user.id))
+
+        read_id, unread = summary.read_state(request.user.id)
+        return Response({"unread": unread, "read_id": read_id})
+
+
+class MessageBatchView(APIView):
+    """Send several messages in one request, e.g. a queue flushed on reconnect"""
+
+    permission_classes = [IsAuthenticated]
+    parser_classes = [*api_settings.DEFAULT_PARSER_CLASSES, MessagePackParser]
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, MessagePackRenderer]
+
+    def post(self, request, *args, **kwargs):
+        csrf_error = csrf_check(request)
+        if csrf_error:
+            return csrf_error
+
+        items = request.data.get("messages")
+        if not isinstance(items, list) or not items:
+            return Response({"detail": "No messages."}, status=400)
+        if len(items) > MESSAGE_BATCH_MAX:
+            return Response(
+                {"detail": f"At most {MESSAGE_BATCH_MAX} messages per batch."},
+                status=400,
+            )
+
+        def receiver_id_of(item):
+            try:
+                return int(item.get("receiver_id"))
+            except (AttributeError, TypeError, ValueError):
+                return None
+
+        # All receivers validated with one query
+        receiver_ids = {receiver_id_of(item) for item in items} - {None}
+        existing_ids = set(
+            User.objects.filter(id__in=receiver_ids).values_list("id", flat=True)
+        )
+
+        results = []
+        new_messages = []
+        for index, item in enumerate(items):
+            receiver_id = receiver_id_of(item)
+            if receiver_id is None:
+                results.append({"status": 400, "detail": "Invalid receiver_id."})
+                continue
+            if receiver_id not in existing_ids:
+                results.append({"status": 404, "detail": "User does not exist."})
+                continue
+            serializer = MessageSerializer(data=item)
+            if not serializer.is_valid():
+                results.append({"status": 400, "errors": serializer.errors})
+                continue
+            results.append(None)
+            new_messages.append(
+                (
+                    index,
+                    Message(
+                        sender=request.user,
+                        receiver_id=receiver_id,
+                        conversation=Message.conversation_key(request.user.id, receiver_id),
+                        **serializer.validated_data,
+                    ),
+                )
+            )
+
+        if not new_messages:
+            return Response({"results": results}, status=status.HTTP_400_BAD_REQUEST)
+
+        # bulk_create skips Message.save, so versions and pushes are done here
+        with transaction.atomic():
+            created = Message.objects.bulk_create([message for _, message in new_messages])
+            ConversationSummary.record_messages(created)
+            for message in created:
+                transaction.on_commit(lambda message=message: publish_message(message))
+        for (index, _), message in zip(new_messages, created):
+            results[index] = {"status": 201, "id": message.id}
+        bump(
+            *{messages_version(message.conversation) for message in created},
+            *{conversations_version(message.receiver_id) for message in created},
+            conversations_version(request.user.id),
+        )
+
+        if len(created) == len(items):
+            return Response({"results": results}, status=status.HTTP_201_CREATED)
+        return Response({"results": results}, status=status.HTTP_207_MULTI_STATUS)
+
+
+def get_conversation_data(user, other_user_id, params, binary=False):
+    """Serialized conversation slice for the history and wait endpoints.
+    ``binary`` leaves ciphertext as raw bytes.
+
+    Raises ValueError on a malformed id or cursor.
+    """
+    messages = Message.get_conversation(user, other_user_id)
+    compact = params.get("compact") in ("1", "true")
+    if compact:
+        # Profiles go out once in "participants" instead of on every message
+        messages = messages.only("id", "sender", "content", "iv", "timestamp")
+        serializer_class = CompactMessageSerializer
+    else:
+        messages = messages.select_related("sender", "receiver")
+        serializer_class = MessageSerializer
+
+    query, limit = message_page_query(messages, params)
+    page, cursors = message_page(list(query), params, limit)
+    data = {
+        "results": serializer_class(page, many=True, context={"binary": binary}).data,
+        **cursors,
+    }
+    if compact:
+        participants = User.objects.filter(id__in={user.id, int(other_user_id)})
+        participants = participants.only("id", "username", "e2ee_public_key")
+        data["participants"] = FriendSerializer(participants, many=True).data
+    return data
+
+
+@sheds_load
+async def message_wait_view(request):
+    """Long-poll for messages newer than ?after= in the conversation ?with="""
+    if request.method != "GET":
+        return method_not_allowed()
+
+    user = await authenticate_async(request)
+    if user is None:
+        return not_authenticated(request)
+
+    try:
+        other_user_id = int(request.GET["with"])
+        after = int(request.GET["after"])
+        timeout = float(request.GET.get("timeout", MESSAGE_WAIT_TIMEOUT))
+        if not math.isfinite(timeout):
+            raise ValueError("timeout must be finite")
+    except (KeyError, ValueError):
+        return JsonResponse({"detail": "Missing or invalid parameters."}, status=400)
+    timeout = min(max(timeout, 0), MESSAGE_WAIT_TIMEOUT_MAX)
+    params = {"after": after, "compact": request.GET.get("compact")}
+
+    # Subscribe before the first read so nothing sent in between is missed
+    hub = get_hub()
+    try:
+        queue = await hub.subscribe(user.id)
+    except redis.RedisError:
+        queue = None
+
+    metrics.message_waiters.inc()
+    try:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            data = await run_blocking(
+                get_conversation_data, user, other_user_id, params, binary=wants_msgpack(request)
+            )
+            remaining = deadline - loop.time()
+            if data["results"] or queue is None or remaining <= 0:
+                return negotiated_response(request, data)
+            # Park without a thread until this conversation gets a message
+            try:
+                while True:
+                    event = json.loads(await asyncio.wait_for(queue.get(), remaining))
+                    if event["message"]["sender_id"] == other_user_id:
+                        break
+                    remaining = deadline - loop.time()
+            except asyncio.TimeoutError:
+                return negotiated_response(request, data)
+    finally:
+        metrics.message_waiters.dec()
+        if queue is not None:
+            await hub.unsubscribe(user.id, queue)
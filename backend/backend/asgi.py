@@ -2,15 +2,42 @@
 ASGI config for backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP goes to Django, WebSocket connections on ``/ws/messages/`` get pushed
+new messages.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
 
+import logging
 import os
 
+from django.conf import settings
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+if settings.DEBUG:
+    # runserver used to serve the admin's static files in development
+    django_application = ASGIStaticFilesHandler(django_application)
+
+# Imported after Django is set up since it loads models
+from api.jobs import resume_stale_purges  # noqa: E402
+from api.realtime import WEBSOCKET_PATH, websocket_application  # noqa: E402
+
+try:
+    # Purges whose worker died before this one started
+    resume_stale_purges()
+except Exception:
+    logging.getLogger(__name__).warning("Could not resume message purges", exc_info=True)
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "websocket":
+        if scope["path"] == WEBSOCKET_PATH:
+            return await websocket_application(scope, receive, send)
+        await receive()
+        return await send({"type": "websocket.close", "code": 4404})
+    return await django_application(scope, receive, send)
@@ -48,15 +48,66 @@ SIMPLE_JWT = {
     "BLACKLIST_AFTER_ROTATION": True,
 }
 
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379")
+# Pool for direct Redis use (rate limits, pub/sub), waits up to the timeout
+# for a free connection instead of opening more
+REDIS_POOL_MAX_CONNECTIONS = int(os.getenv("REDIS_POOL_MAX_CONNECTIONS", "50"))
+REDIS_POOL_TIMEOUT = 5  # seconds
+
+# Progressive rate limiting: exceeding a limit bans the ip from that scope,
+# each further violation there within RATE_LIMIT_VIOLATION_TTL bans it for longer
+RATE_LIMITS = {
+    "login": {"limit": 5, "window": 60},
+    "admin_login": {"limit": 5, "window": 60},
+    "register": {"limit": 15, "window": 60 * 60},
+}
+RATE_LIMIT_BAN_DURATIONS = [60, 600, 1800]  # seconds: 1 min, 10 min, 30 min
+RATE_LIMIT_VIOLATION_TTL = 60 * 60
+
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.redis.RedisCache",
-        "LOCATION": "redis://redis:6379",
+        "BACKEND": "api.cache.RedisCache",
+        "LOCATION": REDIS_URL,
     }
 }
 
 AUTH_USER_MODEL = "api.User"
 
+# Users resolved from access tokens, cached in process and in Redis
+AUTH_USER_CACHE = {
+    "local_ttl": 5,  # seconds
+    "local_size": 1024,
+    "redis_ttl": 5 * 60,
+}
+
+# Login attempts are written in batches off the login request
+# overflow: "sync" writes inline when the buffer is full, "drop" discards
+LOGIN_ATTEMPT_BUFFER = {
+    "max_size": 10000,
+    "batch_size": 200,
+    "flush_interval": 1.0,  # seconds
+    "overflow": "sync",
+}
+
+# Prometheus metrics on /metrics/, scraped with Authorization: Bearer <token>.
+# Disabled while METRICS_TOKEN is unset. Each worker publishes its counters
+# to Redis every flush_interval, workers silent for worker_ttl are dropped
+METRICS = {
+    "token": os.getenv("METRICS_TOKEN", ""),
+    "flush_interval": 5,  # seconds
+    "worker_ttl": 30,
+}
+
+# Per request SQL checks: more queries than budgets[url name] or the same
+# query shape repeat_threshold times (N+1) is logged, or raised when strict.
+# The test suite runs strict with the budgets in api/tests.py
+QUERY_BUDGET = {
+    "enabled": DEBUG,
+    "strict": False,
+    "repeat_threshold": 3,
+    "budgets": {},
+}
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -74,6 +125,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "api.metrics.MetricsMiddleware",
+    "api.querybudget.QueryBudgetMiddleware",
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -108,12 +161,64 @@ WSGI_APPLICATION = 'backend.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite unless DB_ENGINE is postgres or sqlite_wal, see docker-compose.yml for the postgres service
+DB_ENGINE = os.getenv("DB_ENGINE", "sqlite")
+
+if DB_ENGINE == "postgres":
+    # Connections come from a psycopg pool per worker process. Without the pool
+    # (DB_POOL=0) each thread keeps its own connection for DB_CONN_MAX_AGE.
+    DB_POOL = os.getenv("DB_POOL", "1") == "1"
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "HOST": os.getenv("DB_HOST", "localhost"),
+            "PORT": os.getenv("DB_PORT", "5432"),
+            "NAME": os.getenv("DB_NAME", "secprog"),
+            "USER": os.getenv("DB_USER", "secprog"),
+            "PASSWORD": os.getenv("DB_PASSWORD", ""),
+            "CONN_MAX_AGE": 0 if DB_POOL else int(os.getenv("DB_CONN_MAX_AGE", "60")),
+            "CONN_HEALTH_CHECKS": True,
+            "OPTIONS": {
+                # Milliseconds, a runaway query is cancelled instead of holding a connection
+                "options": f"-c statement_timeout={int(os.getenv('DB_STATEMENT_TIMEOUT', '5000'))}",
+            },
+        }
+    }
+    if DB_POOL:
+        DATABASES["default"]["OPTIONS"]["pool"] = {
+            "min_size": int(os.getenv("DB_POOL_MIN_SIZE", "2")),
+            "max_size": int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+            "timeout": float(os.getenv("DB_POOL_TIMEOUT", "10")),  # seconds to wait for a connection
+        }
+elif DB_ENGINE == "sqlite_wal":
+    # Small deployments on SQLite: WAL so reads don't wait for writers, and
+    # one writer at a time per process instead of "database is locked"
+    DATABASES = {
+        "default": {
+            "ENGINE": "backend.sqlite_wal",
+            "NAME": BASE_DIR / "db.sqlite3",
+            "OPTIONS": {
+                # Take the write lock when a transaction starts, not halfway through
+                "transaction_mode": "IMMEDIATE",
+                # Seconds to wait for the write lock, sets SQLite's busy_timeout
+                "timeout": 20,
+                "init_command": (
+                    "PRAGMA journal_mode=WAL;"
+                    "PRAGMA synchronous=NORMAL;"
+                    "PRAGMA mmap_size=268435456;"  # 256 MB
+                    "PRAGMA cache_size=-65536;"  # 64 MB
+                    "PRAGMA temp_store=MEMORY"
+                ),
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        }
     }
-}
 
 # https://docs.djangoproject.com/en/5.1/topics/auth/passwords/
 # Use Argon2id instead of PBKDF2
@@ -125,6 +230,21 @@ PASSWORD_HASHERS = [
     "django.contrib.auth.hashers.ScryptPasswordHasher",
 ]
 
+# Threads per worker process for ORM, cache and sync view work (api.threads).
+# Each holds a database connection, keep max_workers within DB_POOL_MAX_SIZE.
+# Requests beyond max_pending get a 503, None runs everything on Django's
+# single thread sensitive thread instead
+REQUEST_THREAD_POOL = {
+    "max_workers": int(os.getenv("REQUEST_THREADS", "10")),
+    "max_pending": 256,
+}
+
+# Logins verify passwords in a bounded pool, extra requests get a 503
+PASSWORD_HASHING_POOL = {
+    "max_workers": max(1, (os.cpu_count() or 2) // 2),
+    "max_pending": 32,
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
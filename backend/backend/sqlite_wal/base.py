@@ -0,0 +1,96 @@
+import threading
+from contextlib import contextmanager
+
+from django.db import OperationalError
+from django.db.backends.sqlite3 import base
+
+
+# One writer lock per database file, shared by every thread of the process
+_writer_locks = {}
+
+READ_STATEMENTS = ("SELECT", "PRAGMA", "EXPLAIN")
+
+
+class SQLiteCursorWrapper(base.SQLiteCursorWrapper):
+    wrapper = None
+
+    def execute(self, query, params=None):
+        with self.wrapper.writer_lock_for(query):
+            return super().execute(query, params)
+
+    def executemany(self, query, param_list):
+        with self.wrapper.writer_lock_for(query):
+            return super().executemany(query, param_list)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """SQLite that lets one thread write at a time instead of failing with
+    "database is locked".
+
+    Transactions start with BEGIN IMMEDIATE and hold the process writer lock
+    until they end, writes in autocommit hold it for the statement. Readers
+    never take it, WAL lets them run next to the writer. Other processes
+    still wait on the busy timeout.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # setdefault is atomic, threads opening their first connection get the same lock
+        self.writer_lock = _writer_locks.setdefault(
+            str(self.settings_dict["NAME"]), threading.Lock()
+        )
+        self.writer_lock_timeout = self.settings_dict["OPTIONS"].get("timeout", 5)
+        self.holds_writer_lock = False
+
+    def acquire_writer_lock(self):
+        if not self.writer_lock.acquire(timeout=self.writer_lock_timeout):
+            raise OperationalError("database is locked (waited for the writer lock)")
+        self.holds_writer_lock = True
+
+    def release_writer_lock(self):
+        if self.holds_writer_lock:
+            self.holds_writer_lock = False
+            self.writer_lock.release()
+
+    @contextmanager
+    def writer_lock_for(self, query):
+        if self.holds_writer_lock or query.lstrip()[:7].upper().startswith(READ_STATEMENTS):
+            yield
+            return
+        self.acquire_writer_lock()
+        try:
+            yield
+        finally:
+            self.release_writer_lock()
+
+    def create_cursor(self, name=None):
+        cursor = self.connection.cursor(factory=SQLiteCursorWrapper)
+        cursor.wrapper = self
+        return cursor
+
+    def _start_transaction_under_autocommit(self):
+        self.acquire_writer_lock()
+        try:
+            super()._start_transaction_under_autocommit()
+        except Exception:
+            self.release_writer_lock()
+            raise
+
+    def _commit(self):
+        try:
+            return super()._commit()
+        finally:
+            self.release_writer_lock()
+
+    def _rollback(self):
+        try:
+            return super()._rollback()
+        finally:
+            self.release_writer_lock()
+
+    def _close(self):
+        try:
+            return super()._close()
+        finally:
+            self.release_writer_lock()
+
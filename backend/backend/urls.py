@@ -17,54 +17,83 @@ Including another URLconf
 
 from django.contrib import admin
 from django.urls import path
+from api.metrics import metrics_view
+from api.threads import in_thread_pool
 from api.views import (
     CustomAdminLoginView,
     CreateUserView,
-    CustomTokenObtainPairView,
+    login_view,
     CustomTokenRefreshView,
-    CheckAuthenticationView,
+    check_authentication_view,
     logout_view,
-    FriendListView,
+    friend_list_view,
+    friends_overview_view,
     FriendRequestView,
     PendingFriendRequestsView,
     RespondToFriendRequestView,
     SentFriendRequestsView,
     delete_friend,
     UpdateUserView,
-    MessageView,
+    message_view,
+    MessageBatchView,
+    MessagePurgeStatusView,
+    message_wait_view,
+    conversation_list_view,
+    ConversationReadView,
 )
 
 admin.site.login = CustomAdminLoginView.as_view()
 
+# Sync views are served from the request threads (api.threads), under ASGI
+# Django would run them all on one thread per process
 urlpatterns = [
     path("notadmin/", admin.site.urls),
-    path("api/user/register/", CreateUserView.as_view(), name="register"),
-    path("api/token/", CustomTokenObtainPairView.as_view(), name="get_token"),
-    path("api/token/refresh/", CustomTokenRefreshView.as_view(), name="refresh_token"),
-    path("api/auth-check/", CheckAuthenticationView.as_view(), name="auth_check"),
-    path("api/user/logout/", logout_view, name="logout"),
-    path("api/friends/", FriendListView.as_view(), name="friend_list"),
+    path("metrics/", metrics_view, name="metrics"),
+    path("api/user/register/", in_thread_pool(CreateUserView.as_view()), name="register"),
+    path("api/token/", login_view, name="get_token"),
+    path(
+        "api/token/refresh/",
+        in_thread_pool(CustomTokenRefreshView.as_view()),
+        name="refresh_token",
+    ),
+    path("api/auth-check/", check_authentication_view, name="auth_check"),
+    path("api/user/logout/", in_thread_pool(logout_view), name="logout"),
+    path("api/friends/", friend_list_view, name="friend_list"),
+    path("api/friends/overview/", friends_overview_view, name="friends_overview"),
     path(
         "api/friendrequest/send/",
-        FriendRequestView.as_view(),
+        in_thread_pool(FriendRequestView.as_view()),
         name="send_friendrequest",
     ),
     path(
         "api/friendrequest/respond/<int:pk>/",
-        RespondToFriendRequestView.as_view(),
+        in_thread_pool(RespondToFriendRequestView.as_view()),
         name="respond_friendrequest",
     ),
     path(
         "api/friendrequest/view/",
-        PendingFriendRequestsView.as_view(),
+        in_thread_pool(PendingFriendRequestsView.as_view()),
         name="friendrequests_view",
     ),
     path(
         "api/friendrequest/sent/",
-        SentFriendRequestsView.as_view(),
+        in_thread_pool(SentFriendRequestsView.as_view()),
         name="friendrequests_sent_view",
     ),
-    path("api/friend/delete/", delete_friend, name="del_friend"),
-    path("api/user/update/", UpdateUserView.as_view(), name="update_user"),
-    path("api/message/", MessageView.as_view(), name="message"),
+    path("api/friend/delete/", in_thread_pool(delete_friend), name="del_friend"),
+    path("api/user/update/", in_thread_pool(UpdateUserView.as_view()), name="update_user"),
+    path("api/message/", message_view, name="message"),
+    path("api/message/wait/", message_wait_view, name="message_wait"),
+    path("api/conversations/", conversation_list_view, name="conversation_list"),
+    path(
+        "api/conversations/<int:other_user_id>/read/",
+        in_thread_pool(ConversationReadView.as_view()),
+        name="conversation_read",
+    ),
+    path("api/message/batch/", in_thread_pool(MessageBatchView.as_view()), name="message_batch"),
+    path(
+        "api/message/delete/<str:job_id>/",
+        in_thread_pool(MessagePurgeStatusView.as_view()),
+        name="message_purge_status",
+    ),
 ]
@@ -10,7 +10,7 @@ import {
     ListItemText,
     Checkbox,
 } from "@mui/material"
-import { Friend, Message } from "../types"
+import { Friend, Message, MessagePage } from "../types"
 import { convertPublicKey, decryptMessages, genSharedKey, getPrivateKey } from "../KeyGeneration"
 import { useSession } from "./RouteProtected"
 
@@ -31,7 +31,11 @@ const ChatWindow: React.FC<ChatWindowProps> = ({
     encryptionKey
 }) => {
     const bottomRef = useRef<HTMLDivElement | null>(null);
+    // Newest message id shown, long-polls ask for anything after it
+    const lastIdRef = useRef<number | null>(null)
     const [messages, setMessages] = useState<Message[]>([])
+    // ?before= cursor for the page before the oldest message shown, null when there is none
+    const [olderCursor, setOlderCursor] = useState<number | null>(null)
     const [newMessage, setNewMessage] = useState("")
     const [decrypted, setDecrypted] = useState(false)
     const [autoDecrypt, setAutoDecrypt] = useState(true)
@@ -50,7 +54,7 @@ const ChatWindow: React.FC<ChatWindowProps> = ({
         // Encrypt message and send to backend
         await encryptAndSendMessage(newMessage, friend.id, friend.e2ee_public_key)
         setNewMessage("")
-        await fetchMessages(friend.id)
+        await fetchNewer()
 
     }
     const getSharedKey = async () => {
@@ -79,6 +83,63 @@ const ChatWindow: React.FC<ChatWindowProps> = ({
         }
     }
 
+    // Pages added to the list are decrypted when the rest of it is
+    const preparePage = async (page: Message[]) => {
+        if (!autoDecrypt && !decrypted) {
+            return page
+        }
+        const sharedKey = await getSharedKey()
+        return sharedKey ? await decryptMessages(page, sharedKey) : page
+    }
+
+    const appendNewer = async (data: MessagePage) => {
+        if (!data.results.length) {
+            return
+        }
+        const newer = await preparePage(data.results)
+        lastIdRef.current = Math.max(lastIdRef.current ?? 0, data.next ?? 0)
+        // The long-poll and a send can both deliver the same message
+        setMessages((shown) => {
+            const shownIds = new Set(shown.map((msg) => msg.id))
+            return [...shown, ...newer.filter((msg) => !shownIds.has(msg.id))]
+        })
+    }
+
+    const fetchNewer = async () => {
+        try {
+            const response = await fetch(
+                API_URL + `/api/message/?with=${friend.id}&after=${lastIdRef.current ?? 0}`,
+                { credentials: 'include' }
+            )
+            if (response.status == 200) {
+                await appendNewer(await response.json())
+            }
+        } catch (error) {
+            console.log(error)
+        }
+    }
+
+    const fetchOlder = async () => {
+        if (olderCursor === null) {
+            return
+        }
+        try {
+            const response = await fetch(
+                API_URL + `/api/message/?with=${friend.id}&before=${olderCursor}`,
+                { credentials: 'include' }
+            )
+            if (response.status == 200) {
+                const data: MessagePage = await response.json()
+                const older = await preparePage(data.results)
+                setOlderCursor(data.has_more ? data.previous : null)
+                setMessages((shown) => [...older, ...shown])
+            }
+        } catch (error) {
+            console.log(error)
+        }
+    }
+
+    // Latest page of the conversation
     const fetchMessages = async (id: number) => {
         setDecrypted(false)
         try {
@@ -91,11 +152,13 @@ const ChatWindow: React.FC<ChatWindowProps> = ({
 
             })
             if (response.status == 200) {
-                const data = await response.json()
+                const data: MessagePage = await response.json()
+                lastIdRef.current = data.next ?? 0
+                setOlderCursor(data.has_more ? data.previous : null)
                 if (autoDecrypt) {
-                    await handleDecryptMessages(data)
+                    await handleDecryptMessages(data.results)
                 }
-                setMessages(data)
+                setMessages(data.results)
             } else {
                 if(response.status === 401) {
                     window.location.reload()
@@ -107,6 +170,7 @@ const ChatWindow: React.FC<ChatWindowProps> = ({
         }
     }
     useEffect(() => {
+        lastIdRef.current = null
         fetchMessages(friend.id)
     }, [friend])
 
@@ -114,14 +178,44 @@ const ChatWindow: React.FC<ChatWindowProps> = ({
         bottomRef.current?.scrollIntoView({ behavior: 'smooth' });
     }, [messages]);
 
-    // Fetch messages every 5 seconds
+    // Long-poll for new messages, the server answers as soon as the friend sends one
     useEffect(() => {
-        const interval = setInterval(() => {
-            fetchMessages(friend.id)
-        }, 5000)
+        const controller = new AbortController()
+        const sleep = (ms: number) => new Promise((resolve) => setTimeout(resolve, ms))
 
-        return () => clearInterval(interval)
-    }, [autoDecrypt])
+        const waitForMessages = async () => {
+            while (!controller.signal.aborted) {
+                if (lastIdRef.current === null) {
+                    // First fetch still running
+                    await sleep(500)
+                    continue
+                }
+                try {
+                    const response = await fetch(
+                        API_URL + `/api/message/wait/?with=${friend.id}&after=${lastIdRef.current}`,
+                        { credentials: 'include', signal: controller.signal }
+                    )
+                    if (response.status === 200) {
+                        await appendNewer(await response.json())
+                    } else {
+                        if (response.status === 401) {
+                            window.location.reload()
+                        }
+                        await sleep(5000)
+                    }
+                } catch (error) {
+                    if (controller.signal.aborted) {
+                        return
+                    }
+                    console.log(error)
+                    await sleep(5000)
+                }
+            }
+        }
+        waitForMessages()
+
+        return () => controller.abort()
+    }, [friend, autoDecrypt, decrypted])
 
     return (
         <Box ref={bottomRef} >
@@ -140,8 +234,15 @@ const ChatWindow: React.FC<ChatWindowProps> = ({
                 Auto Decrypt
             </Typography>
             <List sx={{ maxHeight: "500px", overflowY: "auto", mb: 2, minHeight: "500px" }}>
-                {messages.map((msg, idx) => (
-                    <ListItem key={idx} sx={{ justifyContent: msg.sender.id !== friend.id ? "flex-end" : "flex-start" }}>
+                {olderCursor !== null && (
+                    <ListItem sx={{ justifyContent: "center" }}>
+                        <Button onClick={async () => await fetchOlder()}>
+                            LOAD OLDER
+                        </Button>
+                    </ListItem>
+                )}
+                {messages.map((msg) => (
+                    <ListItem key={msg.id} sx={{ justifyContent: msg.sender.id !== friend.id ? "flex-end" : "flex-start" }}>
                         <ListItemText ref={bottomRef}
                             sx={{
                                 maxWidth: "60%",
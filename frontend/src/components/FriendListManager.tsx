@@ -24,17 +24,17 @@ const FriendlistManager = () => {
 
     const fetchAllData = async () => {
         try {
-            const [friendsRes, incomingRes, sentRes] = await Promise.all([
-                fetch(API_URL + "/api/friends/", { method: 'GET', headers: { 'Content-Type': 'application/json' }, credentials: 'include' }),
-                fetch(API_URL + "/api/friendrequest/view/", { method: 'GET', headers: { 'Content-Type': 'application/json' }, credentials: 'include' }),
-                fetch(API_URL + "/api/friendrequest/sent/", { method: 'GET', headers: { 'Content-Type': 'application/json' }, credentials: 'include' }),
-            ])
-            if(friendsRes.status === 401) {
+            // Friends, incoming and sent requests in one call
+            const response = await fetch(API_URL + "/api/friends/overview/", { method: 'GET', headers: { 'Content-Type': 'application/json' }, credentials: 'include' })
+            if(response.status === 401) {
                 window.location.reload()
             }
-            if (friendsRes.ok) setFriends(await friendsRes.json())
-            if (incomingRes.ok) setFriendRequests(await incomingRes.json())
-            if (sentRes.ok) setSentFriendRequests(await sentRes.json())
+            if (response.ok) {
+                const overview = await response.json()
+                setFriends(overview.friends)
+                setFriendRequests(overview.received)
+                setSentFriendRequests(overview.sent)
+            }
         } catch (error) {
             console.error(error)
         }
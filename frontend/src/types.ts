@@ -15,9 +15,20 @@ export type FriendRequest = {
 }
 
 export type Message = {
+    id: number
     sender: Friend
     receiver: Friend
     content: string
     iv: string
     timestamp: string
 }
+
+// A slice of a conversation with its id cursors
+export type MessagePage = {
+    results: Message[]
+    // Pass as ?after= to fetch newer messages
+    next: number | null
+    // Pass as ?before= to fetch older messages
+    previous: number | null
+    has_more: boolean
+}